@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+"""analytics
+
+热搜度趋势分析模块，依赖 numpy。
+
+一次加载所有关键词 12 个月的热搜度为矩阵，按列向量化计算环比增长、3/6/12 月斜率、
+峰值月份和波动率。缺失的月份不参与计算。
+"""
+
+import re
+import warnings
+import numpy as np
+from dateutil.relativedelta import relativedelta
+from models import SRH_PV_KEYS
+
+def compute_trends(matrix):
+    """计算热搜度趋势
+
+    Args:
+        matrix (numpy.ndarray): n x 12 的热搜度矩阵，列从最早的月份到本月，缺失值为 nan。
+
+    Returns:
+        dict: 每个关键词一个值的数组，包括 this_mon、growth（环比增长率，上月为 0 时为 nan）、
+            slope_3、slope_6、slope_12（最近 N 个月中有数据的月份的最小二乘斜率，单位为热搜度/月，
+            少于 2 个月有数据时为 nan）、peak（峰值距本月的月数，没有数据时为 -1）和
+            volatility（有数据的月份的变异系数）。
+    """
+    months = matrix.shape[1]
+    this_mon = matrix[:, -1]
+    last_mon = matrix[:, -2]
+    with np.errstate(divide='ignore', invalid='ignore'), warnings.catch_warnings():
+        # 没有数据的关键词 nanmean 会警告并返回 nan
+        warnings.simplefilter('ignore', RuntimeWarning)
+        growth = np.where(last_mon > 0, (this_mon - last_mon) / last_mon, np.nan)
+        volatility = np.nanstd(matrix, axis=1) / np.nanmean(matrix, axis=1)
+
+    trends = {'this_mon': this_mon, 'growth': growth, 'volatility': volatility}
+    for n in (3, 6, 12):
+        trends['slope_%d' % n] = _masked_slope(matrix[:, -n:])
+    peak = months - 1 - np.where(np.isnan(matrix), -np.inf, matrix).argmax(axis=1)
+    trends['peak'] = np.where(np.isnan(matrix).all(axis=1), -1, peak)
+    return trends
+
+def _masked_slope(matrix):
+    """按行计算最小二乘斜率，只使用非 nan 的值，少于 2 个值时为 nan"""
+    valid = ~np.isnan(matrix)
+    count = valid.sum(axis=1)
+    x = np.where(valid, np.arange(matrix.shape[1]), 0.0)
+    y = np.where(valid, matrix, 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_mean = x.sum(axis=1) / count
+        y_mean = y.sum(axis=1) / count
+        dx = np.where(valid, x - x_mean[:, None], 0.0)
+        slope = (dx * (y - y_mean[:, None])).sum(axis=1) / (dx * dx).sum(axis=1)
+    return np.where(count >= 2, slope, np.nan)
+
+class TrendReport():
+    """热搜度趋势报表数据，按 3 月斜率从高到低排序
+
+    Args:
+        database (Database): 数据库对象。
+        reg_categories (str): 类目正则表达式，与 keywords 报表的过滤条件相同。
+    """
+
+    def __init__(self, database, reg_categories=''):
+        regex = re.compile(reg_categories) if reg_categories else None
+        # 热搜度列从最早的月份到本月
+        months = len(SRH_PV_KEYS)
+        columns = ['update'] + SRH_PV_KEYS[::-1] + (['category'] if regex is not None else [])
+        rows = list()
+        for row in database.iter_keywords(*columns):
+            if row[2:2+months].count(None) == months:
+                continue
+            if regex is not None and not regex.search(str(row[-1])):
+                continue
+            rows.append(row)
+        valid = set(database.filter_negative([x[0] for x in rows]))
+        rows = [x for x in rows if x[0] in valid]
+
+        self.keywords = [x[0] for x in rows]
+        self.updates = [x[1] for x in rows]
+        self.matrix = np.array(
+            [x[2:2+months] for x in rows], dtype=float
+        ).reshape(len(rows), months)
+        self.trends = compute_trends(self.matrix)
+
+    def rows(self):
+        """生成报表行，列与 CSV_Generator.generate_trends_csv 的表头相同"""
+        slope = self.trends['slope_3']
+        order = np.argsort(-np.where(np.isnan(slope), -np.inf, slope), kind='mergesort')
+        columns = list()
+        for name in ['this_mon', 'growth', 'slope_3', 'slope_6', 'slope_12', 'volatility']:
+            values = self.trends[name][order]
+            column = np.round(values, 4).astype(object)
+            column[np.isnan(values)] = "-"
+            columns.append(column.tolist())
+        # 峰值月份只与数据月份和峰值位置有关，重复的组合只计算一次
+        peak_months = dict()
+        keys = [(self.updates[i], peak) for i, peak in
+                zip(order.tolist(), self.trends['peak'][order].tolist())]
+        for update, peak in set(keys):
+            peak_months[(update, peak)] = "-"
+            if update is not None and peak >= 0:
+                # update 为数据月份的下个月
+                peak_months[(update, peak)] = \
+                    (update + relativedelta(months=-1-peak)).strftime('%Y/%m')
+        keywords = [self.keywords[i] for i in order.tolist()]
+        this_mon, growth, slope_3, slope_6, slope_12, volatility = columns
+        for row in zip(keywords, this_mon, growth, slope_3, slope_6, slope_12,
+                       [peak_months[x] for x in keys], volatility):
+            yield list(row)
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+"""cache
+
+产品缓存模块，保存 id 和规范化关键词到产品的映射。
+"""
+
+from normalizer import normalize_keyword
+from metrics import REGISTRY
+
+class ProductCache():
+    """产品缓存。
+
+    第一次查询时通过 loader 加载所有产品并建立索引，写入产品后需要调用 invalidate，
+    下次查询时会重新加载。命中和未命中次数同时记录到 REGISTRY 的计数器中。
+
+    Args:
+        loader (callable): 返回所有 Product 对象的函数。
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.hits = 0
+        self.misses = 0
+        self.products = None
+        self.id_index = dict()
+        self.keyword_index = dict()
+
+    def _ensure_loaded(self):
+        if self.products is not None:
+            self.hits += 1
+            REGISTRY.inc('spider_product_cache_hits_total')
+            return
+        self.misses += 1
+        REGISTRY.inc('spider_product_cache_misses_total')
+        self.products = self.loader()
+        for product in self.products:
+            self.id_index[product.id] = product
+            keywords = set(normalize_keyword(x) for x in product.keywords or [])
+            for keyword in keywords:
+                self.keyword_index.setdefault(keyword, list()).append(product)
+
+    def invalidate(self):
+        """清空缓存"""
+        self.products = None
+        self.id_index = dict()
+        self.keyword_index = dict()
+
+    def get_all(self):
+        self._ensure_loaded()
+        return self.products
+
+    def get_by_id(self, product_id):
+        self._ensure_loaded()
+        return self.id_index.get(product_id)
+
+    def get_by_keyword(self, keyword_norm):
+        """获取包含规范化关键词的产品列表"""
+        self._ensure_loaded()
+        return list(self.keyword_index.get(keyword_norm, []))
+
+    def stats(self):
+        """缓存统计
+
+        Returns:
+            dict: hits、misses 和缓存的产品数 size。
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': 0 if self.products is None else len(self.products),
+        }
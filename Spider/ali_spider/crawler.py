@@ -2,29 +2,71 @@
 """
 
 import re
-import sys
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
-import time
 import os
-import pickle
+import time
 import random
-import http.cookiejar
+import threading
+import itertools
+from functools import partial
+from urllib.parse import urlsplit
 import http.client
 import requests
-from selenium.common import exceptions as selenium_exceptions
-from selenium import webdriver
-import selenium.webdriver.support.ui as ui
 import crawlerparser
+import planner
 import settings
+from ratelimit import RateLimiter
+from frontier import Frontier
+from pipeline import Pipeline
 from models import Keyword
+from normalizer import normalize_keyword
+from metrics import REGISTRY
+from sessionstate import SessionState, LOGIN_COOKIE
+from resilience import CircuitBreakers, backoff_delay
+
+# 各 host 的请求使用的 token
+_HOST_TOKENS = {
+    'hz-productposting.alibaba.com': ['product_csrf_token', 'category_csrf_token'],
+    'hz-mydata.alibaba.com': ['ctoken', 'dmtrack_pageid'],
+    'www2.alibaba.com': ['p4p_csrf_token'],
+}
+
+# 登录失效时会被重定向到这些页面
+_LOGIN_URL = re.compile(r'//(login|passport)\.alibaba\.com')
+
+class SessionInvalidError(Exception):
+    """响应表明登录状态或 token 已失效"""
+
+class RequestFailedError(Exception):
+    """请求重试后仍然失败"""
+
+class LoginError(Exception):
+    """selenium 登录失败，爬取无法继续"""
 
 class Crawler():
     """爬虫类"""
 
-    def __init__(self, database):
+    def __init__(self, database, concurrency=None):
         self._init_webdriver()
         self.database = database
+        self.concurrency = max(concurrency or settings.CRAW_CONCURRENCY, 1)
+        self._cookies_lock = threading.Lock()
+        # 保护 session 的重建和 token 的获取
+        self._session_lock = threading.RLock()
+        # session 每次重建加一，用于判断失效的 session 是否已被其他线程重建
+        self._session_generation = 0
+        # host -> 连续限流的响应数
+        self._throttled_counts = dict()
+        self._throttled_lock = threading.Lock()
+        self.rate_limiter = RateLimiter()
+        self.circuit_breakers = CircuitBreakers()
+        # (连接超时, 读取超时)，避免请求无限等待
+        self.timeout = (settings.HTTP_CONNECT_TIMEOUT, settings.HTTP_READ_TIMEOUT)
+        self.state = SessionState.load(
+            settings.SESSION_STATE_FILE,
+            cookies_file=os.path.join(os.path.dirname(os.path.abspath(__file__)), './cookies.pkl')
+        )
         self.cookies = self._get_cookies()
         self.session = self._create_session()
         http.client.HTTPConnection.debuglevel = settings.HTTP_DEBUGLEVEL
@@ -37,6 +79,12 @@ class Crawler():
     def craw_products(self, page=1, forceupdate=False):
         """craw products
 
+        Only products modified since the latest stored modify time are fetched and upserted. If
+        the products count on server differs from the local count after that, or the last id
+        pass or full sync is PRODUCTS_ID_PASS_DAYS old, an id pass finds the removed products
+        and fetches the products missing locally, such as the pages left by an interrupted full
+        sync. With forceupdate or empty products table all products are fetched.
+
         Args:
             page (int): beging page from craw, default value is 1.
 
@@ -46,89 +94,186 @@ class Crawler():
             return
 
         page_size = 50
-        csrf_token = self._get_product_csrf_token()
-        manager = RequestManager()
+        since = None if forceupdate else self.database.get_latest_product_modify_time()
 
-        first_request = self._prepare_products_request(
-            csrf_token=csrf_token,
-            page=page,
-            page_size=page_size
+        if since is None:
+            product_ids = self._craw_all_products(page, page_size)
+            if page == 1:
+                self.database.delete_products_except(product_ids)
+                self.database.set_last_run('products_id_pass')
+        else:
+            products_count = self._craw_modified_products(since, page_size)
+            # 同时新增和删除产品时总数不变，所以也定期检查所有产品 id
+            last_id_pass = self.database.get_last_run('products_id_pass')
+            if (products_count != self.database.get_products_count() or last_id_pass is None
+                    or last_id_pass + relativedelta(days=settings.PRODUCTS_ID_PASS_DAYS)
+                    <= datetime.now()):
+                product_ids = self._craw_product_ids(page_size)
+                self.database.delete_products_except(product_ids)
+                self.database.set_last_run('products_id_pass')
+        self.database.touch_products()
+
+    def _craw_all_products(self, page, page_size):
+        """craw and upsert all products from `page`, return the crawled product ids."""
+        product_ids = set()
+
+        def write(results):
+            products = [x for _, page_products in results for x in page_products]
+            self.database.upsert_products(products)
+            product_ids.update(x.id for x in products)
+            for page, _ in results:
+                print("[Product] %02d [done]" % page)
+
+        self._craw_product_pages(
+            page, page_size,
+            parse=lambda response: crawlerparser.parse_product(response, page_size)[1],
+            write=write,
         )
-        manager.add_request(first_request)
-        self.database.delete_all_products()
-
-        while manager.has_request():
-            print("[Product] %02d" % page, end=" ")
-            new_request = manager.get_request()
-            response = self._send_request(new_request)
-            page, products = crawlerparser.parse_product(response, page_size)
-            self.database.add_products(products)
-            print("[done]")
+        return product_ids
 
-            if page is None:
+    def _craw_modified_products(self, since, page_size):
+        """craw and upsert products modified since `since`, return the products count on server.
+
+        Products are requested in modify time descending order, so it stop at the first page
+        containing an older product.
+        """
+        products_count = 0
+        pages = self._fetch_product_pages(1, page_size, order='desc')
+        for page, response in pages:
+            print("[Product] modified %02d" % page, end=" ")
+            products_count = crawlerparser.parse_product_count(response)
+            _, products = crawlerparser.parse_product(response, page_size)
+            modified_products = [x for x in products if x.modify_time.date() >= since]
+            self.database.upsert_products(modified_products)
+            print("[done]")
+            if len(modified_products) < len(products):
+                pages.close()
                 break
+        return products_count
 
-            next_request = self._prepare_products_request(
-                csrf_token=csrf_token,
-                page=page,
-                page_size=page_size
-            )
-            manager.add_request(next_request)
-        
-    def craw_keywords(self, keywords=None, index=0, page=1, forceupdate=False):
+    def _craw_product_ids(self, page_size):
+        """craw all product ids on server, return them.
+
+        Only the products missing locally are built and upserted, a full sync interrupted after
+        writing later pages would leave them behind the latest modify time.
+        """
+        product_ids = set()
+        local_ids = self.database.get_product_ids()
+
+        def parse(response):
+            page_product_ids = crawlerparser.parse_product_ids(response)
+            if all(x in local_ids for x in page_product_ids):
+                return page_product_ids, []
+            products = crawlerparser.parse_product(response, page_size)[1]
+            return page_product_ids, [x for x in products if x.id not in local_ids]
+
+        def write(results):
+            missing_products = list()
+            for page, (page_product_ids, page_missing_products) in results:
+                product_ids.update(page_product_ids)
+                missing_products.extend(page_missing_products)
+                print("[Product] id %02d [done]" % page)
+            self.database.upsert_products(missing_products)
+
+        self._craw_product_pages(1, page_size, parse=parse, write=write)
+        return product_ids
+
+    def _craw_product_pages(self, page, page_size, parse, write):
+        """craw products pages from `page` to the last page through the pipeline.
+
+        The first page is fetched on this thread, the products count in it gives all rest pages.
+        parse(response) is called on the parse thread, write(results) on this thread with a list
+        of (page, parse result).
+        """
+        build = partial(self._build_products_request, page_size=page_size)
+        response = self._send_with_retry(partial(build, page=page))
+        write([(page, parse(response))])
+
+        page_count = crawlerparser.parse_product_page_count(response, page_size)
+        pipeline = self._create_pipeline(
+            fetch=lambda x: self._send_with_retry(partial(build, page=x)),
+            parse=lambda x, response: parse(response),
+            write=write,
+        )
+        with pipeline:
+            for x in range(page + 1, page_count + 1):
+                pipeline.put(x)
+            pipeline.join()
+        print('[Pipeline] %s' % pipeline.format_stats())
+
+    def _fetch_product_pages(self, page, page_size, order='asc'):
+        """yield (page, response) of products pages from `page` to the last page, one by one."""
+        for page in itertools.count(page):
+            response = self._send_with_retry(partial(
+                self._build_products_request, page=page, page_size=page_size, order=order
+            ))
+            yield page, response
+            if page >= crawlerparser.parse_product_page_count(response, page_size):
+                return
+
+    def craw_keywords(self, keywords=None, index=0, page=1, forceupdate=False, category=True):
         """craw keywords infomation
 
         craw all keywords and contains products keywords, base keywords and extension keywords.
+        Requests are kept in the frontier, an interrupted craw continues from where it stopped.
 
         Args:
             index (int): the keywords list index for the beginning craw.
             page (int): the keyword request page for the beginning craw.
+            category (bool): craw the keywords category after the keywords.
         """
         
         if keywords is None:
-            keywords = self.database.get_product_keywords()
-            keywords.extend(self.database.get_base_file_keywords())
-            keywords = sorted(set(keywords))
+            keywords = self.database.get_craw_keywords()
         
-        keyword_manager = RequestManager()
         page_size = 10
-        keyword = keywords[index]
-        first_request = self._prepare_keywords_request(keyword, page, page_size)
-        keyword_manager.add_request(first_request)
-
-        while keyword_manager.has_request():
-            print('[Keyword] %05d-%03d:"%s"' % (index, page, keyword), end=" ")
-
-            new_request = keyword_manager.get_request()
-            if page > 1 or self.database.is_keyword_need_upsert(keyword):
-                response = self._send_request(new_request)
-                page, page_keywords = crawlerparser.parse_keyword(
-                    keyword=keyword,
-                    response=response,
-                    page=page,
-                    page_size=page_size
-                )
-                self.database.upsert_keywords(page_keywords)
-            else:
-                print('is exist & unneed update', end=" ")
-                page = None
-                       
-            print("[done]")
+        keyword_index = {x: i for i, x in enumerate(keywords)}
+        plan = planner.plan_keywords(self.database, keywords[index:], forceupdate=forceupdate)
+        print(planner.format_plan('Keyword', len(keywords) - index, plan))
+        frontier = Frontier(
+            self.database, 'keyword',
+            builder=partial(self._prepare_keywords_request, page_size=page_size)
+        )
+        with frontier:
+            if page > 1:
+                frontier.add_request({'keyword': keywords[index], 'page': page})
+            frontier.add_requests([
+                {'keyword': x, 'page': 1} for x in plan.keywords if page == 1 or x != keywords[index]
+            ])
+
+            self._craw_frontier(
+                frontier,
+                parse=partial(self._parse_keywords, page_size=page_size),
+                write=partial(self._write_keywords, frontier=frontier, keyword_index=keyword_index),
+            )
+
+        if category:
+            self.craw_keywords_category()
+
+    @staticmethod
+    def _parse_keywords(task, response, page_size):
+        return crawlerparser.parse_keyword(
+            keyword=task['keyword'],
+            response=response,
+            page=task['page'],
+            page_size=page_size
+        )
 
-            if page is None:
+    def _write_keywords(self, results, frontier, keyword_index):
+        self.database.upsert_keywords(
+            [x for _, (_, page_keywords) in results for x in page_keywords or []]
+        )
+        for item, (next_page, _) in results:
+            keyword, page = (item.task['keyword'], item.task['page'])
+            print('[Keyword] %05d-%03d:"%s" [done]' % (keyword_index.get(keyword, -1), page, keyword))
+            if next_page is None:
                 # add none record if keywords information is None
                 self.database.insert_none_keyword(keyword)
-                # go to next keyword
-                index, page = (index + 1, 1)
-                if index >= len(keywords):
-                    break
-                keyword = keywords[index]
-
-            next_request = self._prepare_keywords_request(keyword, page, page_size)
-            keyword_manager.add_request(next_request)
+            else:
+                # next page is crawled before the next keyword
+                frontier.add_request({'keyword': keyword, 'page': next_page}, priority=1)
+        frontier.done_all([x for x, _ in results])
 
-        self.craw_keywords_category()
-        
     def craw_keywords_category(self, index=0, forceupdate=False):
         """craw keywords category information.
 
@@ -136,30 +281,38 @@ class Crawler():
             index (int): keywords index, default 0.
         """
         keywords = self.database.get_all_keywords()
-        request_manager = RequestManager()
-        keyword = keywords[index]
-        csrf_token = self._get_category_csrf_token()
-        first_request = self._prepare_catrgory_request(keyword=keyword.value, ctoken=csrf_token)
-        request_manager.add_request(first_request)
-
-        while request_manager.has_request():
-            print('[Category] %05d:"%s"' % (index, keyword.value), end=" ")
-
-            new_request = request_manager.get_request()
-            if self.database.is_keyword_category_need_update(keyword):
-                response = self._send_request(new_request)
-                index, category = crawlerparser.parse_category(response=response, index=index)
-                self.database.update_keyword_category(keyword=keyword, category=category)
-            else:
-                print('is unneed update', end=" ")
-                index += 1
-            print("[done]")
-            if index >= len(keywords):
-                break
-            keyword = keywords[index]
-            next_request = self._prepare_catrgory_request(keyword=keyword.value, ctoken=csrf_token)
-            request_manager.add_request(next_request)
-        
+        keyword_index = {x.value: i for i, x in enumerate(keywords)}
+        frontier = Frontier(self.database, 'category', builder=self._build_category_request)
+        with frontier:
+            # 已有类目的关键词不需要请求
+            frontier.add_requests([
+                {'keyword': x.value} for x in keywords[index:]
+                if self.database.is_keyword_category_need_update(x)
+            ])
+            self._craw_frontier(
+                frontier,
+                parse=partial(self._parse_category, keyword_index=keyword_index),
+                write=partial(self._write_categories, frontier=frontier, keywords=keywords),
+            )
+
+    @staticmethod
+    def _parse_category(task, response, keyword_index):
+        index = keyword_index.get(task['keyword'])
+        if index is None:
+            return None, None
+        _, category = crawlerparser.parse_category(response=response, index=index)
+        return index, category
+
+    def _write_categories(self, results, frontier, keywords):
+        categories = list()
+        for item, (index, category) in results:
+            if index is None:
+                continue
+            print('[Category] %05d:"%s" [done]' % (index, keywords[index].value))
+            categories.append((keywords[index], category))
+        self.database.update_keywords_category(categories)
+        frontier.done_all([x for x, _ in results])
+
     def craw_rank(self, keywords=None, index=0, forceupdate=False):
         """craw keywords rank information.
 
@@ -169,54 +322,164 @@ class Crawler():
         if keywords is None:
             keywords = self.database.get_valid_keywords()
         
-        keywords = [re.sub(" +", " ", x.lower()) for x in keywords]
-        ctoken = self._get_ctoken()
-        dmtrack_pageid = self._get_dmtrack_pageid()
+        keywords = [normalize_keyword(x) for x in keywords]
 
         if index >= len(keywords):
             print('index over range')
             return
 
-        while index is not None and index < len(keywords):
-            keyword = keywords[index]
+        keyword_index = {x: i for i, x in enumerate(keywords)}
+        plan = planner.plan_ranks(self.database, keywords[index:], forceupdate=forceupdate)
+        print(planner.format_plan('Rank', len(keywords) - index, plan))
+        frontier = Frontier(self.database, 'rank', builder=self._build_rank_request)
+        with frontier:
+            frontier.add_requests([{'keyword': x} for x in plan.keywords])
+
+            self._craw_frontier(
+                frontier,
+                parse=partial(self._parse_rank, keywords=keywords, keyword_index=keyword_index),
+                write=partial(self._write_ranks, frontier=frontier),
+            )
+        self.database.compact_rank_history()
 
-            print('[Rank] %04d:"%s"' % (index, keyword), end=" ")
-            
-            if forceupdate or self.database.is_rank_need_upsert(keyword):
-                new_request = self._prepare_rank_request(keyword=keyword, ctoken=ctoken, dmtrack_pageid=dmtrack_pageid)
-                response = self._send_request(new_request)
-                index, rank = crawlerparser.parse_rank(response, index, keywords)
-                self.database.upsert_rank(rank)
-            else:
-                print('is exist & unneed update', end=" ")
-                index += 1
-            
+    @staticmethod
+    def _parse_rank(task, response, keywords, keyword_index):
+        index = keyword_index.get(task['keyword'])
+        if index is None:
+            return None, None, None
+        next_index, rank = crawlerparser.parse_rank(response, index, keywords)
+        return index, next_index, rank
+
+    def _write_ranks(self, results, frontier):
+        ranks, done_items = (list(), list())
+        for item, (index, next_index, rank) in results:
+            if index is None:
+                done_items.append(item)
+                continue
+            print('[Rank] %04d:"%s"' % (index, rank.keyword), end=" ")
+            if next_index == index:
+                # 响应无法解析，稍后重试，多次失败后移入 dead letter 表
+                retry = self._fail_request(frontier, item, 'unparsable rank response')
+                print("[retry]" if retry else "[dead letter]")
+                continue
+            ranks.append(rank)
+            done_items.append(item)
             print("[done]")
-      
+        # 每批结果一次写入
+        self.database.bulk_upsert_ranks(ranks)
+        frontier.done_all(done_items)
+
     def craw_p4p(self, forceupdate=False):
         """craw p4p keywords and information"""
 
-        self.database.delete_all_p4p()
-        manager = RequestManager()
-        csrf_token = self._get_p4p_csrf_token()
-        page = 1
-        first_request = self._prepare_p4p_request(page=page, csrf_token=csrf_token)
-        manager.add_request(first_request)
+        frontier = Frontier(self.database, 'p4p', builder=self._build_p4p_request)
+        with frontier:
+            if not frontier.resumed:
+                self.database.delete_all_p4p()
+            frontier.add_request({'page': 1})
 
-        while manager.has_request():
-            print('[P4P] %02d' % page, end=" ")
+            self._craw_frontier(
+                frontier,
+                parse=lambda task, response: crawlerparser.parse_p4p(response=response),
+                write=partial(self._write_p4ps, frontier=frontier),
+            )
 
-            new_request = manager.get_request()
-            response = self._send_request(new_request)
-            page, p4ps = crawlerparser.parse_p4p(response=response)
-            self.database.add_p4ps(p4ps)
-            print("[done]")
+    def _write_p4ps(self, results, frontier):
+        self.database.add_p4ps([x for _, (_, p4ps) in results for x in p4ps])
+        for item, (next_page, _) in results:
+            print('[P4P] %02d [done]' % item.task['page'])
+            if next_page is not None:
+                frontier.add_request({'page': next_page})
+        frontier.done_all([x for x, _ in results])
+
+    @staticmethod
+    def _fail_request(frontier, item, error):
+        """release a failed frontier request or move it to the dead letters, return True if
+        it will be retried."""
+        retry = frontier.fail(item, error)
+        if not retry:
+            REGISTRY.inc('spider_dead_letters_total', kind=frontier.kind)
+        return retry
+
+    def _create_pipeline(self, fetch, parse, write):
+        return Pipeline(
+            fetch=fetch,
+            parse=parse,
+            write=write,
+            workers=self.concurrency,
+            queue_size=settings.PIPELINE_QUEUE_SIZE,
+            batch_size=settings.PIPELINE_BATCH_SIZE,
+        )
+
+    def _craw_frontier(self, frontier, parse, write):
+        """craw the frontier requests through the fetch, parse and write pipeline.
+
+        Requests are sent by `concurrency` threads and parsed on another thread with
+        parse(task, response). write(results) is called on this thread with a list of
+        (frontier item, parse result), so it can use the database and the frontier. Requests
+        added to the frontier by write are crawled in the same run. A request that fails after
+        the retries or can't be parsed is released for another attempt or moved to the dead
+        letters, write only gets the parsed results.
+        """
+        # 其他线程只使用 task 的副本，frontier item 只在本线程中使用
+        # 登录状态失效时用新的 token 重新创建请求
+        def fetch_task(x):
+            try:
+                return self._send_with_retry(partial(frontier.builder, **x[1]))
+            except RequestFailedError as e:
+                return e
+
+        def parse_response(x, response):
+            if isinstance(response, Exception):
+                return response
+            try:
+                return parse(x[1], response)
+            except (crawlerparser.ParseError, ValueError, KeyError, IndexError, TypeError) as e:
+                # 无法解析的响应与失败的请求一样稍后重试
+                return e
+
+        def write_results(results):
+            succeeded = list()
+            for x, result in results:
+                if not isinstance(result, Exception):
+                    succeeded.append((x[0], result))
+                    continue
+                retry = self._fail_request(frontier, x[0], result)
+                print('[%s] %s [%s] %s' % (
+                    frontier.kind.title(), x[1], 'retry' if retry else 'dead letter', result))
+            if len(succeeded) > 0:
+                write(succeeded)
+
+        pipeline = self._create_pipeline(
+            fetch=fetch_task, parse=parse_response, write=write_results
+        )
+        with pipeline:
+            while True:
+                leased = frontier.get_requests(self.concurrency * 10)
+                for item in leased:
+                    pipeline.put((item, dict(item.task)))
+                if len(leased) == 0:
+                    pipeline.join()
+                    if not frontier.has_request():
+                        break
+        print('[Pipeline] %s' % pipeline.format_stats())
+
+    def _build_products_request(self, page, page_size, order='asc'):
+        return self._prepare_products_request(
+            self._get_product_csrf_token(), page=page, page_size=page_size, order=order
+        )
+
+    def _build_category_request(self, keyword):
+        return self._prepare_catrgory_request(keyword, ctoken=self._get_category_csrf_token())
+
+    def _build_rank_request(self, keyword):
+        return self._prepare_rank_request(
+            keyword, ctoken=self._get_ctoken(), dmtrack_pageid=self._get_dmtrack_pageid()
+        )
+
+    def _build_p4p_request(self, page):
+        return self._prepare_p4p_request(page, csrf_token=self._get_p4p_csrf_token())
 
-            if page is None:
-                break
-            new_request = self._prepare_p4p_request(page=page, csrf_token=csrf_token)
-            manager.add_request(new_request)
-        
     @staticmethod
     def _prepare_p4p_request(page, csrf_token):
         url = "http://www2.alibaba.com/asyGetAdKeyword.do"
@@ -240,7 +503,7 @@ class Crawler():
         return req
 
     @staticmethod
-    def _prepare_products_request(csrf_token, page, page_size):
+    def _prepare_products_request(csrf_token, page, page_size, order='asc'):
         url = "http://hz-productposting.alibaba.com/product/managementproducts/\
 asyQueryProductsList.do"
         headers = {
@@ -263,7 +526,7 @@ asyQueryProductsList.do"
             'displayStatus': 'all',
             'repositoryType': 'all',
             'samplingTag': 'false',
-            'gmtModified': 'asc',
+            'gmtModified': order,
             'marketType': 'all',
         }
         req = requests.Request('POST', url, data=data, headers=headers)
@@ -346,26 +609,91 @@ asyQueryProductsList.do"
         return req
 
     def _get_product_csrf_token(self):
+        return self._get_token('product_csrf_token', self._fetch_product_csrf_token)
+
+    def _fetch_product_csrf_token(self):
         url = "http://hz-productposting.alibaba.com/product/products_manage.htm"
-        html = self.session.get(url).text
+        html = self.session.get(url, timeout=self.timeout).text
         pattern = r"_csrf_token_.*:\s?'(\w+)'"
         product_csrf_token = re.search(pattern, html).group(1)
         return product_csrf_token
 
     def _get_category_csrf_token(self):
+        return self._get_token('category_csrf_token', self._fetch_category_csrf_token)
+
+    def _fetch_category_csrf_token(self):
         url = "http://hz-productposting.alibaba.com/product/posting.htm"
-        html = self.session.get(url).text
+        html = self.session.get(url, timeout=self.timeout).text
         pattern = r"(?<={'_csrf_token_':')\w+(?='})"
         product_csrf_token = re.search(pattern, html).group(0)
         return product_csrf_token
 
     def _get_p4p_csrf_token(self):
+        return self._get_token('p4p_csrf_token', self._fetch_p4p_csrf_token)
+
+    def _fetch_p4p_csrf_token(self):
         url = "http://www2.alibaba.com/manage_ad_keyword.htm"
-        html = self.session.get(url).text
+        html = self.session.get(url, timeout=self.timeout).text
         pattern = r"(?<='_csrf_token_': ')\w+(?=')"
         csrf_token = re.search(pattern, html).group(0)
         return csrf_token
 
+    def _get_token(self, name, fetch):
+        """return the token `name` of the session state, fetch() it if it is not cached.
+
+        A cached token is used until a response shows it is invalid, or TOKEN_MAX_AGE seconds
+        if it is not 0.
+        """
+        with self._session_lock:
+            if self.state.has_token(name, max_age=settings.TOKEN_MAX_AGE):
+                return self.state.get_token(name)
+            token = fetch()
+            self.state.set_token(name, token)
+            self._save_state()
+            return token
+
+    def clear_tokens(self, names=None):
+        """drop the cached tokens `names`, all tokens if None, they are fetched again on next use.
+        """
+        with self._session_lock:
+            for name in list(self.state.tokens) if names is None else names:
+                self.state.tokens.pop(name, None)
+            self._save_state()
+
+    def save_session_state(self):
+        """save the cookies and tokens, the next run starts with them."""
+        with self._session_lock:
+            self._save_state()
+
+    def _save_state(self):
+        # 其他线程发送请求时会修改共享的 cookie jar，pickle 时需要持有 _cookies_lock
+        with self._cookies_lock:
+            self.state.save()
+
+    def refresh_session(self, force=False):
+        """validate the login and create a new session if forced or the login cookie is expired.
+
+        Returns:
+            bool: True if the session is refreshed.
+        """
+        with self._session_lock:
+            if not force and self.state.is_valid():
+                return False
+            self.state.invalidate()
+            self.cookies.clear_expired_cookies()
+            self.session.close()
+            self.session = self._create_session()
+            self._session_generation += 1
+            return True
+
+    def _renew_session(self, generation):
+        """renew the session which was used by a failed request, once for all threads."""
+        with self._session_lock:
+            if generation == self._session_generation:
+                print('[Session] invalid, renew the login and tokens')
+                REGISTRY.inc('spider_session_renewals_total')
+                self.refresh_session(force=True)
+
     def _create_session(self):
         """创建 requests session"""
         session = requests.Session()
@@ -378,38 +706,42 @@ asyQueryProductsList.do"
             'Connection': 'keep-alive',
             'Upgrade-Insecure-Requests': '1',
         }
-        resp = session.get('http://i.alibaba.com/index.htm', allow_redirects=False)
+        # 每个 host 一个连接池，连接数与并发数一致
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(self.concurrency, 10))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if settings.HTTP_PROXY:
+            session.proxies = {'http': settings.HTTP_PROXY, 'https': settings.HTTP_PROXY}
+        # 缓存的登录状态有效时不需要验证登录和预热
+        if self.state.is_valid():
+            return session
+        resp = session.get('http://i.alibaba.com/index.htm', allow_redirects=False, timeout=self.timeout)
         if resp.status_code != 200:
             session.cookies = self.cookies = self._get_cookies(force_update=True)
-            session.get('http://i.alibaba.com/index.htm')
-        session.get('http://hz-mydata.alibaba.com/self/keyword.htm')
-        session.get('http://hz-productposting.alibaba.com/product/products_manage.htm')
-        session.get('http://hz-mydata.alibaba.com/industry/keywords.htm')
-        session.get('http://hz-productposting.alibaba.com/product/posting.htm')
-        session.get('http://www2.alibaba.com/home/index.htm')
+            session.get('http://i.alibaba.com/index.htm', timeout=self.timeout)
+        session.get('http://hz-mydata.alibaba.com/self/keyword.htm', timeout=self.timeout)
+        session.get('http://hz-productposting.alibaba.com/product/products_manage.htm', timeout=self.timeout)
+        session.get('http://hz-mydata.alibaba.com/industry/keywords.htm', timeout=self.timeout)
+        session.get('http://hz-productposting.alibaba.com/product/posting.htm', timeout=self.timeout)
+        session.get('http://www2.alibaba.com/home/index.htm', timeout=self.timeout)
+        self.state.mark_validated()
+        self._save_state()
         return session
 
     def _get_cookies(self, force_update=False):
-        cookies = None
-        dump_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), './cookies.pkl')
-        if force_update or not os.path.exists(dump_file):
-            cookies = self._get_cookies_via_selenium()
-            self._dump_cookies(cookies=cookies)
-        else:
-            with open(dump_file, "rb") as dump:
-                cookies = pickle.load(dump)
-        return cookies
+        """return the cookies of the session state, login by selenium if forced or no cookies."""
+        if force_update or self.state.cookies is None:
+            self.state.cookies = self._get_cookies_via_selenium()
+            self.state.invalidate()
+            self._save_state()
+        return self.state.cookies
 
-    def _dump_cookies(self, cookies=None):
-        dump_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), './cookies.pkl')
-        if os.path.exists(dump_file):
-            os.remove(dump_file)
-        with open(dump_file, "wb") as dump:
-            if cookies is None:
-                cookies = self.session.cookies
-            pickle.dump(cookies, dump)
-        
     def _get_cookies_via_selenium(self):
+        # selenium 只在需要登录时导入
+        from selenium.common import exceptions as selenium_exceptions
+        from selenium import webdriver
+        import selenium.webdriver.support.ui as ui
+
         driver = webdriver.Firefox()
         try:
             driver.set_page_load_timeout(settings.LOGIN_TIMEOUT)
@@ -429,8 +761,8 @@ asyQueryProductsList.do"
             ui.WebDriverWait(driver, settings.LOGIN_TIMEOUT).until(
                 lambda driver: "i.alibaba.com/index.htm" in driver.current_url)
         except selenium_exceptions.TimeoutException:
-            print("Login timeout, please try again.")
-            sys.exit()
+            # 在 fetch 线程中重建 session 时 sys.exit 只会结束该线程，pipeline 会一直等待
+            raise LoginError("Login timeout, please try again.")
         finally:
             driver_cookies = driver.get_cookies()
             driver.quit()
@@ -458,16 +790,22 @@ asyQueryProductsList.do"
         return cookies
 
     def _get_ctoken(self):
+        return self._get_token('ctoken', self._fetch_ctoken)
+
+    def _fetch_ctoken(self):
         if self.session.cookies is None:
             return None
         for cookie in self.session.cookies:
-            if cookie.name == 'xman_us_t':
+            if cookie.name == LOGIN_COOKIE:
                 pattern = r"(?<=ctoken=)\w+(?=&)"
                 return re.search(pattern, cookie.value).group(0)
 
     def _get_dmtrack_pageid(self):
+        return self._get_token('dmtrack_pageid', self._fetch_dmtrack_pageid)
+
+    def _fetch_dmtrack_pageid(self):
         url = "http://hz-mydata.alibaba.com/self/keyword.htm"
-        html = self.session.get(url).text
+        html = self.session.get(url, timeout=self.timeout).text
         pattern = r"(?<=dmtrack_pageid=')\w+(?=')"
 
         search_result = re.search(pattern, html)
@@ -476,43 +814,141 @@ asyQueryProductsList.do"
         return search_result.group(0)
         
     def _send_request(self, request):
-        # 每次请求之间需要有一定的时间间隔
-        if request.cookies is None:
-            self.cookies.update(self.session.cookies)
-        else:
-            self.cookies.update(request.cookies)
-        request.cookies = self.cookies
-        resp = self.session.send(request.prepare())
-        time.sleep(random.uniform(settings.CRAW_SLEEP_MIN, settings.CRAW_SLEEP_MAX))
+        with self._cookies_lock:
+            if request.cookies is None:
+                self.cookies.update(self.session.cookies)
+            else:
+                self.cookies.update(request.cookies)
+            request.cookies = self.cookies
+            prepared_request = request.prepare()
+        url = urlsplit(prepared_request.url)
+        endpoint = url.hostname + url.path
+        # host 连续失败时熔断器打开，等待 host 恢复后再发送
+        wait = self.circuit_breakers.acquire(prepared_request.url)
+        REGISTRY.observe('spider_circuit_wait_seconds', wait, host=url.hostname)
+        # 每个 host 的请求速率由令牌桶控制，服务器限流时自动降速
+        wait = self.rate_limiter.acquire(prepared_request.url)
+        REGISTRY.observe('spider_ratelimit_wait_seconds', wait, host=url.hostname)
+        start = time.perf_counter()
+        try:
+            resp = self.session.send(prepared_request, timeout=self.timeout)
+        except requests.RequestException as e:
+            REGISTRY.inc('spider_http_errors_total', endpoint=endpoint, error=type(e).__name__)
+            self._circuit_feedback(url.hostname, prepared_request.url, failed=True)
+            raise
+        finally:
+            REGISTRY.observe('spider_http_request_seconds', time.perf_counter() - start,
+                             endpoint=endpoint)
+        REGISTRY.inc('spider_http_requests_total', endpoint=endpoint, status=resp.status_code)
+        REGISTRY.inc('spider_http_response_bytes_total', len(resp.content), endpoint=endpoint)
+        self._circuit_feedback(url.hostname, prepared_request.url,
+                               failed=self._is_server_error(resp))
+        if self._is_session_invalid(resp):
+            REGISTRY.inc('spider_http_session_invalid_total', endpoint=endpoint)
+            raise SessionInvalidError('%d %s' % (resp.status_code, resp.url))
+        throttled = self._is_throttled(resp)
+        if throttled:
+            REGISTRY.inc('spider_http_throttled_total', endpoint=endpoint)
+        self.rate_limiter.feedback(prepared_request.url, throttled=throttled)
+        self._count_throttled(url.hostname, throttled)
         return resp
 
-class RequestManager():
-    """请求队列管理器。"""
-
-    def __init__(self):
-        self.requests = set()
-        self.old_requests = set()
+    def _count_throttled(self, host, throttled):
+        """连续 TOKEN_THROTTLE_LIMIT 个限流响应后清除 host 的 token，下次创建请求时重新获取，
+        仍然连续限流 TOKEN_THROTTLE_LIMIT 次时重建 session
 
-    def add_request(self, item):
-        """添加请求到请求队列中。"""
-        if item is None:
+        过期的 token 可能不会得到 401/403，而是被当作限流拒绝。ctoken 来自登录 cookie，
+        只有重建 session 才会更新。
+        """
+        limit = settings.TOKEN_THROTTLE_LIMIT
+        with self._throttled_lock:
+            count = self._throttled_counts.get(host, 0) + 1 if throttled else 0
+            self._throttled_counts[host] = 0 if limit and count >= limit * 2 else count
+        if not limit or count < limit:
             return
-        if item not in self.requests and item not in self.old_requests:
-            self.requests.add(item)
+        if count == limit and host in _HOST_TOKENS:
+            print('[Session] %s keeps throttling, fetch its tokens again' % host)
+            REGISTRY.inc('spider_token_refreshes_total', host=host)
+            self.clear_tokens(_HOST_TOKENS[host])
+        elif count >= limit * 2:
+            self._renew_session(self._session_generation)
+
+    def _circuit_feedback(self, host, url, failed):
+        if self.circuit_breakers.feedback(url, failed=failed):
+            print('[Circuit] %s is failing, pause its requests' % host)
+            REGISTRY.inc('spider_circuit_opens_total', host=host)
+
+    def _send_with_retry(self, build):
+        """send the request returned by build(), retry it when it fails.
+
+        Connection errors, timeouts and throttled responses (see _is_throttled), which carry no
+        data, are retried HTTP_RETRIES times after an exponential backoff with jitter. If the
+        response shows the login or the tokens are invalid, the session is renewed and the
+        request is built again with the new tokens, at most SESSION_RENEW_LIMIT times.
+
+        Raises:
+            RequestFailedError: the request still fails after the retries.
+        """
+        retries, renewals = (0, 0)
+        while True:
+            generation = self._session_generation
+            try:
+                response = self._send_request(build())
+                if not self._is_throttled(response):
+                    return response
+                error = 'throttled HTTP %d %s' % (response.status_code, response.url)
+            except SessionInvalidError as e:
+                if renewals >= settings.SESSION_RENEW_LIMIT:
+                    raise RequestFailedError('session invalid: %s' % e) from e
+                renewals += 1
+                self._renew_session(generation)
+                continue
+            except (requests.ConnectionError, requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError) as e:
+                error = '%s: %s' % (type(e).__name__, e)
+            if retries >= settings.HTTP_RETRIES:
+                raise RequestFailedError(error)
+            delay = backoff_delay(retries)
+            retries += 1
+            REGISTRY.inc('spider_http_retries_total')
+            REGISTRY.observe('spider_http_backoff_seconds', delay)
+            time.sleep(delay)
 
-    def add_requests(self, items):
-        """批量添加请求到队列中。"""
-        if items is None or len(items) == 0:
-            return
-        for item in items:
-            self.add_request(item)
-
-    def has_request(self):
-        """是否存在为处理的请求"""
-        return len(self.requests) != 0
-
-    def get_request(self):
-        """从请求列表中获取新的请求"""
-        request = self.requests.pop()
-        self.old_requests.add(request)
-        return request
+    @staticmethod
+    def _is_server_error(response):
+        """HTTP 429 或 5xx，请求可以稍后重试"""
+        return response.status_code == 429 or response.status_code >= 500
+
+    @staticmethod
+    def _is_session_invalid(response):
+        """判断响应是否表明登录状态或 token 失效：HTTP 401/403 或被重定向到登录页"""
+        if response.status_code in (401, 403):
+            return True
+        urls = [response.url] + [x.headers.get('Location', '') for x in response.history]
+        return any(_LOGIN_URL.search(x) for x in urls)
+
+    @classmethod
+    def _is_throttled(cls, response):
+        """判断响应是否为服务器限流信号：HTTP 429/5xx、非 JSON 响应或没有 value 的 successed false
+
+        带有 value 的 successed false 表示没有数据，由解析器处理。
+        """
+        if response.status_code == 429 or response.status_code >= 500:
+            return True
+        try:
+            resp_json = cls._decode_json(response)
+        except ValueError:
+            return True
+        return (isinstance(resp_json, dict) and resp_json.get('successed') is False
+                and 'value' not in resp_json)
+
+    @staticmethod
+    def _decode_json(response):
+        """解析响应的 JSON，结果保存在 response 中，之后 response.json() 不再重复解析
+
+        Raises:
+            ValueError: 响应不是 JSON。
+        """
+        resp_json = response.json()
+        response.json = lambda **kwargs: resp_json
+        return resp_json
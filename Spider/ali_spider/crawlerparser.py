@@ -4,10 +4,12 @@
 import math
 from datetime import datetime, date
 from dateutil.relativedelta import relativedelta
-from html.parser import HTMLParser
+import html
 from models import Product, Rank, Keyword, P4P
 from json.decoder import JSONDecodeError
+from metrics import timed
 
+@timed('spider_parse')
 def parse_product(response, page_size):
     """产品结果解析器
     """
@@ -34,13 +36,33 @@ def parse_product(response, page_size):
 
     return new_page, products
 
+@timed('spider_parse')
+def parse_product_ids(response):
+    """产品 id 解析器，只解析产品 id
+    """
+    return [item.get('id') for item in response.json()['products']]
+
+@timed('spider_parse')
+def parse_product_count(response):
+    """产品总数解析器
+    """
+    return response.json()['count']
+
+def parse_product_page_count(response, page_size):
+    """产品总页数解析器
+    """
+    return math.ceil(parse_product_count(response) / page_size)
+
+@timed('spider_parse')
 def parse_keyword(keyword, response, page, page_size):
     """keyword 解析器"""
 
     resp_json = response.json()
+    # successed 为 false 时 value 中可能没有数据
+    if not resp_json['successed']:
+        return None, None
     resp_keywords = resp_json['value']['data']
-
-    if not resp_json['successed'] or len(resp_keywords) == 0:
+    if len(resp_keywords) == 0:
         return None, None
 
     resp_total = resp_json['value']['total']
@@ -78,6 +100,7 @@ def parse_keyword(keyword, response, page, page_size):
 
     return next_page, keywords
 
+@timed('spider_parse')
 def parse_category(response, index):
     """category 结果解析器
     """
@@ -88,6 +111,7 @@ def parse_category(response, index):
     except KeyError:
         raise ParseError("数据解析错误")
 
+@timed('spider_parse')
 def parse_rank(response, index, keywords):
     """rank 结果解析器
     """
@@ -110,6 +134,7 @@ def parse_rank(response, index, keywords):
 
     return next_index, rank
 
+@timed('spider_parse')
 def parse_p4p(response):
     resp_json = response.json()
 
@@ -119,10 +144,9 @@ def parse_p4p(response):
 
     p4ps = list()
     data = resp_json['data']
-    parser = HTMLParser()
     for item in data:
         p4ps.append(P4P(
-            keyword=parser.unescape(item['keyword']),
+            keyword=html.unescape(item['keyword']),
             qs_star=item['qsStar'],
             is_start=(item['state']=="1"),
             tag=item['tag'],
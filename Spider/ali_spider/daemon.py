@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+"""daemon
+
+常驻爬虫，一个 Crawler 的 session 和 token 在整个运行期间复用。
+
+每轮按优先级选择第一个需要执行的任务：products、keywords、category、rank、p4p。
+keyword 和 rank 每次只爬取最久未更新的 DAEMON_BATCH_SIZE 个关键词，之后重新选择任务，
+所以新的产品和关键词不需要等待一次完整的 rank 爬取。请求速率仍由 Crawler 的限速器控制。
+失败的任务在 DAEMON_FAILED_RETRY_SECONDS 内不再选择，一个 host 不可用时不会阻塞其他任务。
+"""
+
+import time
+import signal
+import threading
+from functools import partial
+import planner
+import settings
+from metrics import REGISTRY
+
+class Daemon():
+    """常驻爬虫
+
+    Args:
+        crawler (Crawler): 爬虫对象。
+        database (Database): 数据库对象。
+        batch_size (int): 每次 keyword 或 rank 任务的最大关键词数，默认为 DAEMON_BATCH_SIZE。
+        idle_seconds (float): 没有任务或任务失败时的等待秒数，默认为 DAEMON_IDLE_SECONDS。
+    """
+
+    def __init__(self, crawler, database, batch_size=None, idle_seconds=None):
+        self.crawler = crawler
+        self.database = database
+        self.batch_size = max(batch_size or settings.DAEMON_BATCH_SIZE, 1)
+        self.idle_seconds = idle_seconds or settings.DAEMON_IDLE_SECONDS
+        self.stop_event = threading.Event()
+        # 任务名 -> 最近开始时间
+        self.last_runs = dict()
+        # 任务名 -> 最近失败时间，任务成功后清除
+        self.failures = dict()
+        # 任务名 -> {关键词: 最近爬取时间}，爬取后仍未更新的关键词在 DAEMON_RETRY_SECONDS 内不再爬取
+        self.attempts = {'keywords': dict(), 'rank': dict()}
+        # 按优先级排列
+        self.jobs = [
+            ('products', self._plan_products),
+            ('keywords', self._plan_keywords),
+            ('category', partial(self._plan_interval, 'category',
+                                 settings.DAEMON_CATEGORY_SECONDS,
+                                 self.crawler.craw_keywords_category)),
+            ('rank', self._plan_rank),
+            ('p4p', partial(self._plan_interval, 'p4p', settings.DAEMON_P4P_SECONDS,
+                            self.crawler.craw_p4p)),
+        ]
+
+    def stop(self):
+        """当前任务结束后停止"""
+        self.stop_event.set()
+
+    def run(self):
+        """运行直到 stop 被调用或收到 SIGTERM"""
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        print('[Daemon] started, batch %d, idle %ds' % (self.batch_size, self.idle_seconds))
+        while not self.stop_event.is_set():
+            name, job = self._next_job()
+            if job is None:
+                self.stop_event.wait(self.idle_seconds)
+                continue
+            if not self._run_job(name, job):
+                self.stop_event.wait(self.idle_seconds)
+        print('[Daemon] stopped')
+
+    def _next_job(self):
+        """返回第一个需要执行的任务 (name, job)，没有时返回 (None, None)"""
+        # 登录 cookie 过期时重新验证登录，token 失效时由 Crawler 重新获取
+        if self.crawler.refresh_session():
+            print('[Daemon] session refreshed')
+        now = time.time()
+        for name, plan in self.jobs:
+            if now - self.failures.get(name, 0) < settings.DAEMON_FAILED_RETRY_SECONDS:
+                continue
+            job = plan()
+            if job is not None:
+                return name, job
+        return None, None
+
+    def _run_job(self, name, job):
+        print('[Daemon] %s' % name)
+        self.last_runs[name] = time.time()
+        start = time.perf_counter()
+        try:
+            job()
+        except Exception as e:
+            print('[Daemon] %s failed: %s' % (name, e))
+            REGISTRY.inc('spider_daemon_errors_total', job=name, error=type(e).__name__)
+            self.failures[name] = time.time()
+            # 失败可能是 token 失效，下次任务重新获取
+            self.crawler.clear_tokens()
+            return False
+        finally:
+            REGISTRY.observe('spider_daemon_job_seconds', time.perf_counter() - start, job=name)
+            self.crawler.save_session_state()
+        self.failures.pop(name, None)
+        return True
+
+    def _plan_products(self):
+        if self.database.is_products_need_update():
+            return self.crawler.craw_products
+        return None
+
+    def _plan_keywords(self):
+        keywords = self._filter_attempted('keywords', self.database.get_craw_keywords())
+        plan = planner.plan_stale_keywords(self.database, keywords, self.batch_size)
+        if len(plan.keywords) == 0:
+            return None
+        self._mark_attempted('keywords', plan.keywords)
+        return partial(self.crawler.craw_keywords, keywords=plan.keywords, category=False)
+
+    def _plan_rank(self):
+        keywords = self._filter_attempted('rank', self.database.get_valid_keywords())
+        plan = planner.plan_stale_ranks(self.database, keywords, self.batch_size)
+        if len(plan.keywords) == 0:
+            return None
+        self._mark_attempted('rank', plan.keywords)
+        return partial(self.crawler.craw_rank, keywords=plan.keywords)
+
+    def _plan_interval(self, name, seconds, job):
+        if time.time() - self.last_runs.get(name, 0) < seconds:
+            return None
+        return job
+
+    def _filter_attempted(self, name, keywords):
+        now = time.time()
+        attempts = self.attempts[name]
+        return [x for x in keywords if now - attempts.get(x, 0) >= settings.DAEMON_RETRY_SECONDS]
+
+    def _mark_attempted(self, name, keywords):
+        now = time.time()
+        self.attempts[name].update((x, now) for x in keywords)
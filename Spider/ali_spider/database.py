@@ -7,16 +7,24 @@
 
 import os
 import re
+import json
+import sqlite3
 from operator import is_not
 from functools import partial
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 from dateutil.relativedelta import relativedelta
 from pytz import timezone
 from tzlocal import get_localzone
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, func, or_, and_, text, bindparam
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import CreateIndex
 from sqlalchemy.engine.url import make_url
-from models import BASE, Product, Keyword, Rank, P4P
+from models import BASE, Product, ProductKeyword, Keyword, Rank, RankHistory, P4P, \
+    FrontierRequest, DeadLetter, JobRun, JSONEncodedList, ARRAY_TYPE, SRH_PV_KEYS, decode_list
+from cache import ProductCache
+from keywordfilter import NegativeKeywordMatcher
+from normalizer import normalize_keyword
+from metrics import timed
 import settings
 
 class Database():
@@ -30,30 +38,124 @@ class Database():
         url = make_url(settings.DATABASE_URL)
         os.makedirs(os.path.dirname(url.database), exist_ok=True)
         engine = create_engine(settings.DATABASE_URL, echo=settings.DATABASE_ECHO)
+        event.listen(engine, 'connect', self._set_pragmas)
         BASE.metadata.create_all(engine)
         self.session = sessionmaker(bind=engine)()
-        self.products = None
+        self.product_cache = ProductCache(loader=self._load_products)
+        self.negative_keyword_matcher = NegativeKeywordMatcher(settings.NEGATIVE_KEYWORDS_FILE)
+        added_columns = self._add_missing_columns(engine)
+        if ('keywords', 'srh_pv_this_mon') in added_columns:
+            self._migrate_srh_pv_columns()
+        if ('keywords', 'value_norm') in added_columns:
+            duplicates = self._fill_keyword_norm()
+            if duplicates > 0:
+                print("[Migrate] %d keywords have duplicates only differing in case or "
+                      "spacing, run `spider.py migrate` to merge them" % duplicates)
+        self._create_missing_indexes()
+        self._init_product_keywords()
+
+    @staticmethod
+    def _set_pragmas(dbapi_connection, connection_record):
+        """apply the storage profile of settings to a new SQLite connection."""
+        pragmas = [
+            ('journal_mode', settings.DATABASE_JOURNAL_MODE),
+            ('synchronous', settings.DATABASE_SYNCHRONOUS),
+            ('cache_size', settings.DATABASE_CACHE_SIZE),
+            ('mmap_size', settings.DATABASE_MMAP_SIZE),
+        ]
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            if value:
+                cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+
+    def _get_table_columns(self, table_name):
+        return [x[1] for x in self.session.execute(text('PRAGMA table_info("%s")' % table_name))]
+
+    def _add_missing_columns(self, engine):
+        """add the model columns missing in tables created by an older version.
+
+        Returns:
+            set: (table name, column name) of the added columns.
+        """
+        added = set()
+        for table in BASE.metadata.sorted_tables:
+            existing = set(self._get_table_columns(table.name))
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                self.session.execute(text('ALTER TABLE "%s" ADD COLUMN "%s" %s' % (
+                    table.name, column.name, column.type.compile(dialect=engine.dialect))))
+                added.add((table.name, column.name))
+        self.session.commit()
+        return added
+
+    def _create_missing_indexes(self):
+        """create the model indexes missing in tables created by an older version."""
+        for table in BASE.metadata.sorted_tables:
+            existing = set(x[1] for x in self.session.execute(
+                text('PRAGMA index_list("%s")' % table.name)))
+            for index in table.indexes:
+                if index.name not in existing:
+                    self.session.execute(CreateIndex(index))
+        self.session.commit()
+
+    def _load_products(self):
+        """load all products detached from session, so they are not expired by commits."""
+        products = self.session.query(Product).order_by(Product.id).all()
+        for product in products:
+            self.session.expunge(product)
+        return products
+
+    def _init_product_keywords(self):
+        """build the product_keywords table for database created before it exists."""
+        if self.session.query(ProductKeyword).first() is None and \
+           self.session.query(Product).first() is not None:
+            self._index_product_keywords(self.session.query(Product).all())
+            self.session.commit()
+
+    def _index_product_keywords(self, products):
+        """replace the product_keywords rows of the products, the caller should commit."""
+        product_ids = [x.id for x in products]
+        self._delete_product_keywords(product_ids)
+        rows = list()
+        for product in products:
+            keywords = set(normalize_keyword(x) for x in product.keywords or [])
+            rows.extend({'product_id': product.id, 'keyword_norm': x} for x in keywords)
+        if len(rows) > 0:
+            self.session.execute(ProductKeyword.__table__.insert(), rows)
+
+    def _delete_product_keywords(self, product_ids):
+        for i in range(0, len(product_ids), 500):
+            self.session.query(ProductKeyword).filter(
+                ProductKeyword.product_id.in_(product_ids[i:i+500])
+            ).delete(synchronize_session=False)
 
     def get_all_products(self, cache=True):
-        if self.products is None or not cache:
-            self.products = self.session.query(Product).all()
-        return self.products
+        if not cache:
+            self.product_cache.invalidate()
+        return self.product_cache.get_all()
 
     def get_keyword_products(self, keyword):
-        keyword = re.sub(" +", " ", keyword.lower())
-        products = self.get_all_products()
-        keyword_products = list()
-        for item in products:
-            keywords = [re.sub(" +", " ", x.lower()) for x in item.keywords]
-            keyword_products.extend([item for k in keywords if k==keyword])
-        return keyword_products
+        keyword = normalize_keyword(keyword)
+        return self.product_cache.get_by_keyword(keyword)
+
+    def get_keyword_product_ids_map(self):
+        """Get product ids of all normalized keywords with one query.
+
+        Returns:
+            dict: normalized keyword to the list of product ids in id order.
+        """
+        query_result = self.session.query(
+            ProductKeyword.keyword_norm, ProductKeyword.product_id
+        ).order_by(ProductKeyword.product_id).all()
+        product_ids_map = dict()
+        for keyword_norm, product_id in query_result:
+            product_ids_map.setdefault(keyword_norm, list()).append(product_id)
+        return product_ids_map
 
     def get_product_by_id(self, product_id):
-        products = self.get_all_products()
-        for product in products:
-            if product.id == product_id:
-                return product
-        return None
+        return self.product_cache.get_by_id(product_id)
 
     def get_rank_info(self, keyword, product_id):
         ranking, top1_product_id, top1_ranking = (None, None, None)
@@ -72,13 +174,47 @@ class Database():
         return ranking, top1_product_id, top1_ranking
 
     def get_keyword(self, value):
-        value = re.sub(" +", " ", value.lower())
-        keyword = self.session.query(Keyword).filter_by(value=value).first()
+        value_norm = normalize_keyword(value)
+        keyword = self.session.query(Keyword).filter_by(value_norm=value_norm).first()
         return keyword
 
     def get_all_keywords(self):
         return self.session.query(Keyword).all()
 
+    def iter_keywords(self, *columns, batch_size=None):
+        """Iterate keyword columns ordered by value with keyset pagination.
+
+        Only the value and the given columns are loaded, one batch at a time, so the memory
+        usage does not grow with the keywords table.
+
+        Args:
+            columns (str): names of the Keyword columns to load after the value.
+            batch_size (int): rows of each query, default DATABASE_BATCH_SIZE.
+
+        Yields:
+            tuple: (value, *columns) of each keyword.
+        """
+        for rows in self.iter_keyword_batches(*columns, batch_size=batch_size):
+            yield from rows
+
+    def iter_keyword_batches(self, *columns, batch_size=None):
+        """Like iter_keywords, but yield the list of rows of each query.
+
+        Yields:
+            list: (value, *columns) tuples of at most batch_size keywords.
+        """
+        batch_size = batch_size or settings.DATABASE_BATCH_SIZE
+        query = self.session.query(Keyword.value, *[getattr(Keyword, x) for x in columns])
+        last_value = None
+        while True:
+            batch_query = query if last_value is None else query.filter(Keyword.value > last_value)
+            rows = batch_query.order_by(Keyword.value).limit(batch_size).all()
+            if len(rows) > 0:
+                yield [tuple(row) for row in rows]
+            if len(rows) < batch_size:
+                return
+            last_value = rows[-1][0]
+
     def get_p4ps(self):
         """query P4P records from database and return P4P object list.
 
@@ -106,12 +242,64 @@ class Database():
             Product.modify_time).filter_by(id=product_id, style_no=style_no
         ).scalar()
 
+    def get_latest_product_modify_time(self):
+        """Get the newest product modify time in database.
+
+        Returns:
+            date: the newest modify time, None if there is no product.
+        """
+        return self.session.query(func.max(Product.modify_time)).scalar()
+
+    def get_product_ids(self):
+        """Get the ids of all products in database as a set."""
+        return set(q for q, in self.session.query(Product.id).all())
+
+    def get_products_count(self):
+        return self.session.query(Product).count()
+
+    @timed('spider_db_write')
+    def delete_products_except(self, product_ids):
+        """Delete products whose id is not in product_ids.
+
+        Args:
+            product_ids (set): ids of the products should be kept.
+        """
+        removed_ids = [x for x in self.get_product_ids() if x not in product_ids]
+        for i in range(0, len(removed_ids), 500):
+            self.session.query(Product).filter(
+                Product.id.in_(removed_ids[i:i+500])
+            ).delete(synchronize_session=False)
+        self._delete_product_keywords(removed_ids)
+        self.session.commit()
+        self.product_cache.invalidate()
+
+    def get_last_run(self, name):
+        """Get the last completion time of the job `name`, None if it never completed."""
+        return self.session.query(JobRun.finished).filter_by(name=name).scalar()
+
+    def set_last_run(self, name, finished=None):
+        """Record the completion time of the job `name`, default now."""
+        self.session.merge(JobRun(name=name, finished=finished or datetime.now()))
+        self.session.commit()
+
+    @timed('spider_db_write')
+    def touch_products(self):
+        """Mark all products as updated today."""
+        self.session.query(Product).update(
+            {Product.update: date.today()}, synchronize_session=False
+        )
+        self.session.commit()
+        self.product_cache.invalidate()
+
     def delete_all_products(self):
         """Delete all products in datebase."""
 
         self.session.query(Product).delete()
+        self.session.query(ProductKeyword).delete()
         self.session.commit()
+        self.product_cache.invalidate()
 
+    @timed('spider_db_write')
     def delete_all_p4p(self):
         self.session.query(P4P).delete()
         self.session.commit()
@@ -126,7 +314,25 @@ class Database():
         if products is None or len(products) == 0:
             return
         self.session.add_all(products)
+        self._index_product_keywords(products)
+        self.session.commit()
+        self.product_cache.invalidate()
+
+    @timed('spider_db_write')
+    def upsert_products(self, products):
+        """update or insert Product object list to database by product id
+
+        Args:
+            products (list): The list of Product objects will be updated or added.
+        """
+        if products is None or len(products) == 0:
+            return
+        for product in products:
+            product.update = date.today()
+            self.session.merge(product)
+        self._index_product_keywords(products)
         self.session.commit()
+        self.product_cache.invalidate()
 
     def upsert_rank(self, rank):
         """update or insert a Rank object to database
@@ -136,14 +342,7 @@ class Database():
         """
         if rank is None:
             return
-        record = self.session.query(Rank).filter_by(keyword=rank.keyword).first()
-        if record is not None:
-            record.keyword = re.sub(" +", " ", rank.keyword.lower())
-            record.ranking = rank.ranking
-            record.update = rank.update
-        else:
-            self.session.add(rank)
-        self.session.commit()
+        self.bulk_upsert_ranks([rank])
 
     def upsert_keywords(self, keywords):
         """update or insert Keyword object list to database
@@ -153,27 +352,146 @@ class Database():
         """
         if keywords is None or len(keywords) == 0:
             return
-        for keyword in keywords:
-            self.upsert_keyword(keyword=keyword, commit=False)
-        self.session.commit()
+        self.bulk_upsert_keywords(keywords)
     
-    def upsert_keyword(self, keyword, commit=True):
+    def upsert_keyword(self, keyword):
         if keyword is None:
             return
-        record = self.session.query(Keyword).filter_by(value=keyword.value).first()
-        if record is not None:
-            record.value = keyword.value
-            record.repeat_keyword = keyword.repeat_keyword
-            record.company_cnt = keyword.company_cnt
-            record.showwin_cnt = keyword.showwin_cnt
-            record.srh_pv = keyword.srh_pv
-            record.update = keyword.update
-            record.is_p4p_keyword = keyword.is_p4p_keyword
+        self.bulk_upsert_keywords([keyword])
+
+    @timed('spider_db_write')
+    def bulk_upsert_keywords(self, keywords):
+        """update or insert Keyword objects, the category of an existing keyword is kept.
+
+        A keyword is matched by its normalized value, an existing row keeps its value. Keywords
+        of the batch with the same normalized value are written once, the last one wins.
+
+        Args:
+            keywords (list): Keyword list will be updated or inserted.
+        """
+        columns = ['value', 'repeat_keyword', 'company_cnt', 'showwin_cnt', 'update',
+                   'is_p4p_keyword'] + SRH_PV_KEYS
+        rows = [{x: getattr(keyword, x) for x in columns} for keyword in keywords]
+        for row in rows:
+            row['value_norm'] = normalize_keyword(row['value'])
+        rows = list({x['value_norm']: x for x in rows}.values())
+        norms = [x['value_norm'] for x in rows]
+        values = dict()
+        for i in range(0, len(norms), 500):
+            values.update(self.session.query(Keyword.value_norm, Keyword.value).filter(
+                Keyword.value_norm.in_(norms[i:i+500])).all())
+        for row in rows:
+            row['value'] = values.get(row['value_norm'], row['value'])
+        self.bulk_upsert(Keyword, rows)
+
+    @timed('spider_db_write')
+    def bulk_upsert_ranks(self, ranks):
+        """update or insert Rank objects, the rank keyword is normalized.
+
+        Args:
+            ranks (list): Rank list will be updated or inserted.
+        """
+        rows = [{
+            'keyword': normalize_keyword(rank.keyword),
+            'ranking': rank.ranking,
+            'update': rank.update,
+        } for rank in ranks]
+        self._append_rank_history(rows)
+        self.bulk_upsert(Rank, rows)
+
+    def _append_rank_history(self, rows):
+        """add the rank rows to rank_history, the caller should commit.
+
+        A keyword crawled again on the same day replaces the rows of that day.
+        """
+        keywords_by_date = dict()
+        history = list()
+        for row in rows:
+            day = row['update'] or date.today()
+            keywords_by_date.setdefault(day, list()).append(row['keyword'])
+            for x in row['ranking'] or []:
+                history.append({
+                    'keyword': row['keyword'],
+                    'date': day,
+                    'product_id': x['product_id'],
+                    'position': RankHistory.encode_position(x['ranking']),
+                })
+        for day, keywords in keywords_by_date.items():
+            for i in range(0, len(keywords), 500):
+                self.session.query(RankHistory).filter(
+                    RankHistory.date == day, RankHistory.keyword.in_(keywords[i:i+500])
+                ).delete(synchronize_session=False)
+        self._insert_rank_history(history)
+
+    def _insert_rank_history(self, history, prefix='OR REPLACE'):
+        statement = RankHistory.__table__.insert().prefix_with(prefix)
+        count = 0
+        for i in range(0, len(history), settings.DATABASE_BATCH_SIZE):
+            result = self.session.execute(statement, history[i:i+settings.DATABASE_BATCH_SIZE])
+            count += max(result.rowcount, 0)
+        return count
+
+    @timed('spider_db_write')
+    def bulk_upsert_p4ps(self, p4ps):
+        """update or insert P4P objects.
+
+        Args:
+            p4ps (list): P4P list will be updated or inserted.
+        """
+        columns = ['keyword', 'qs_star', 'is_start', 'tag']
+        rows = [{x: getattr(p4p, x) for x in columns} for p4p in p4ps]
+        self.bulk_upsert(P4P, rows)
+
+    def bulk_upsert(self, model, rows):
+        """update or insert rows to the model table in batches.
+
+        SQLite 3.24+ uses INSERT ... ON CONFLICT DO UPDATE, older SQLite uses UPDATE followed by
+        INSERT OR IGNORE. Each batch of `DATABASE_BATCH_SIZE` rows is sent as one executemany, and
+        the session is committed every `DATABASE_COMMIT_INTERVAL` rows and at the end. Rows with
+        the same primary key are written once, the last one wins on both paths.
+
+        Args:
+            model: the mapped class, such as Keyword, Rank or P4P.
+            rows (list): a list of dict whose keys are column names, all dicts have the same keys.
+        """
+        if rows is None or len(rows) == 0:
+            return
+        table = model.__table__
+        columns = list(rows[0].keys())
+        primary_keys = [x.name for x in table.primary_key]
+        update_columns = [x for x in columns if x not in primary_keys]
+        # INSERT OR IGNORE 会保留重复主键中的第一行，ON CONFLICT 保留最后一行，先去重使结果一致
+        rows = list({tuple(x[k] for k in primary_keys): x for x in rows}.values())
+
+        if sqlite3.sqlite_version_info >= (3, 24, 0):
+            statement = text('INSERT INTO "%s" (%s) VALUES (%s) ON CONFLICT (%s) DO UPDATE SET %s' % (
+                table.name,
+                ', '.join('"%s"' % x for x in columns),
+                ', '.join(':%s' % x for x in columns),
+                ', '.join('"%s"' % x for x in primary_keys),
+                ', '.join('"%s" = excluded."%s"' % (x, x) for x in update_columns),
+            )).bindparams(*[bindparam(x, type_=table.c[x].type) for x in columns])
+            statements = [(statement, False)]
         else:
-            self.session.add(keyword)
-        if commit:
-            self.session.commit()
+            update_statement = table.update().where(
+                and_(*[table.c[x] == bindparam('b_' + x) for x in primary_keys])
+            ).values({x: bindparam('b_' + x) for x in update_columns})
+            insert_statement = table.insert().prefix_with('OR IGNORE')
+            statements = [(update_statement, True), (insert_statement, False)]
+
+        uncommitted = 0
+        for i in range(0, len(rows), settings.DATABASE_BATCH_SIZE):
+            batch = rows[i:i+settings.DATABASE_BATCH_SIZE]
+            for statement, prefixed in statements:
+                params = [{'b_' + k: v for k, v in x.items()} for x in batch] if prefixed else batch
+                self.session.execute(statement, params)
+            uncommitted += len(batch)
+            if uncommitted >= settings.DATABASE_COMMIT_INTERVAL:
+                self.session.commit()
+                uncommitted = 0
+        self.session.commit()
     
+    @timed('spider_db_write')
     def insert_none_keyword(self, keyword):
         if self.is_keyword_need_upsert(keyword):
             self.upsert_keyword(
@@ -186,16 +504,26 @@ class Database():
         keyword.category = category
         self.session.commit()
 
+    @timed('spider_db_write')
+    def update_keywords_category(self, categories):
+        """update the category of Keyword objects with one commit.
+
+        Args:
+            categories (list): (keyword, category) tuples.
+        """
+        for keyword, category in categories:
+            keyword.category = category
+        self.session.commit()
+
     def add_p4ps(self, p4ps):
-        """insert P4P object list to database
+        """insert P4P object list to database, a keyword already exist is updated.
 
         Args:
             p4ps (list): a list of P4P objects will be inserted.
         """
         if p4ps is None or len(p4ps) == 0:
             return
-        self.session.add_all(p4ps)
-        self.session.commit()
+        self.bulk_upsert_p4ps(p4ps)
 
     def is_products_need_update(self):
         """measure if a product record need update
@@ -205,9 +533,11 @@ class Database():
         Returns:
             bool: if need update, return True, else return False
         """
-        products_count = self.session.query(Product).count()
-        need_update_count = self.session.query(Product).filter(Product.update < date.today()).count()
-        return products_count == 0 or need_update_count > 0
+        if self.session.query(Product.id).first() is None:
+            return True
+        # 只需判断是否存在过期产品，可以使用 update 索引
+        stale = self.session.query(Product.id).filter(Product.update < date.today()).first()
+        return stale is not None
 
     def is_keyword_need_upsert(self, keyword):
         """measure if a keyword is need update or insert.
@@ -218,10 +548,37 @@ class Database():
         Returns:
             bool: if a keyword is exist and need update return True, else return False.
         """
-        keyword = re.sub(" +", " ", keyword.lower())
+        keyword = normalize_keyword(keyword)
+        record = self.session.query(Keyword).filter(Keyword.value_norm == keyword).first()
+        return record is None or record.update < self._get_keyword_expire_time()
+
+    @staticmethod
+    def _get_keyword_expire_time():
+        """keyword updated before the returned time (US/Pacific, naive) need update."""
         month_ago = datetime.now(get_localzone()).astimezone(timezone('US/Pacific')) + relativedelta(months=-1)
-        record = self.session.query(Keyword).filter(Keyword.value == keyword).first()
-        return record is None or record.update < month_ago.replace(tzinfo=None)
+        return month_ago.replace(tzinfo=None)
+
+    def get_keywords_need_upsert(self, keywords):
+        """measure keywords need update or insert with one query.
+
+        Args:
+            keywords (list): the keywords should be measured.
+
+        Returns:
+            set: keywords which is not exist or need update.
+        """
+        expire_time = self._get_keyword_expire_time()
+        updates = self.get_keyword_updates()
+        need_upsert = set()
+        for keyword in keywords:
+            update = updates.get(normalize_keyword(keyword))
+            if update is None or update < expire_time:
+                need_upsert.add(keyword)
+        return need_upsert
+
+    def get_keyword_updates(self):
+        """return a dict of normalized keyword to its update time."""
+        return dict(self.session.query(Keyword.value_norm, Keyword.update).all())
 
     def is_keyword_category_need_update(self, keyword):
         """measure a keyword's category information is need update or not.
@@ -246,32 +603,180 @@ class Database():
             bool: if the rank information of the keyword is exist and need update, return True,
                 else return False.
         """
-        keyword = re.sub(" +", " ", keyword.lower())
+        keyword = normalize_keyword(keyword)
         record = self.session.query(Rank).filter_by(keyword=keyword).first()
         if record is None or record.update is None:
             return True
         return date.today() > record.update
 
+    def get_ranks_need_upsert(self, keywords):
+        """measure keywords rank need update or insert with one query.
+
+        Args:
+            keywords (list): the keywords should be measured.
+
+        Returns:
+            set: keywords whose rank is not exist or need update.
+        """
+        today = date.today()
+        updates = self.get_rank_updates()
+        need_upsert = set()
+        for keyword in keywords:
+            update = updates.get(normalize_keyword(keyword))
+            if update is None or today > update:
+                need_upsert.add(keyword)
+        return need_upsert
+
+    def get_rank_updates(self):
+        """return a dict of normalized keyword to its rank update date."""
+        return dict(self.session.query(Rank.keyword, Rank.update).all())
+
     def get_keyword_rank_info(self, keyword):
-        keyword = re.sub(" +", " ", keyword.lower())
+        keyword = normalize_keyword(keyword)
         rank = self.session.query(Rank).filter_by(keyword=keyword).first()
         if rank is None or rank.ranking is None:
             return None
         return rank.ranking
 
+    def get_all_rank_info(self):
+        """Get rank information of all keywords with one query.
+
+        Returns:
+            dict: rank keyword to ranking list, keywords without ranking are excluded.
+        """
+        query_result = self.session.query(Rank.keyword, Rank.ranking).all()
+        return {keyword: ranking for keyword, ranking in query_result if ranking is not None}
+
+    def get_keyword_rank_history(self, keyword, start=None, end=None):
+        """Get the rank trajectory of a keyword.
+
+        Args:
+            keyword (str): the keyword, it is normalized.
+            start (date): the first date, None for no limit.
+            end (date): the last date, None for no limit.
+
+        Returns:
+            list: (date, product_id, ranking) tuples ordered by date and ranking.
+        """
+        keyword = normalize_keyword(keyword)
+        query = self.session.query(
+            RankHistory.date, RankHistory.product_id, RankHistory.position
+        ).filter(RankHistory.keyword == keyword)
+        query = self._filter_rank_history_date(query, start, end)
+        query = query.order_by(RankHistory.date, RankHistory.position)
+        return [(x, y, RankHistory.decode_position(z)) for x, y, z in query]
+
+    def get_product_rank_history(self, product_id, start=None, end=None):
+        """Get the rank trajectory of a product.
+
+        Returns:
+            list: (date, keyword, ranking) tuples ordered by date and keyword.
+        """
+        query = self.session.query(
+            RankHistory.date, RankHistory.keyword, RankHistory.position
+        ).filter(RankHistory.product_id == product_id)
+        query = self._filter_rank_history_date(query, start, end)
+        query = query.order_by(RankHistory.date, RankHistory.keyword)
+        return [(x, y, RankHistory.decode_position(z)) for x, y, z in query]
+
+    @staticmethod
+    def _filter_rank_history_date(query, start, end):
+        if start is not None:
+            query = query.filter(RankHistory.date >= start)
+        if end is not None:
+            query = query.filter(RankHistory.date <= end)
+        return query
+
+    @timed('spider_db_write')
+    def compact_rank_history(self, today=None):
+        """Apply the rank history retention policy, at most once a day.
+
+        Rows older than `RANK_HISTORY_RETENTION_DAYS` days are deleted. Rows older than
+        `RANK_HISTORY_DAILY_DAYS` days are downsampled to the best position of each week, dated
+        on Monday. Only the weeks after the cutoff of the last compaction are read.
+
+        Returns:
+            dict: the count of deleted rows and downsampled rows.
+        """
+        today = today or date.today()
+        last_run = self.get_last_run('rank_history_compact')
+        if last_run is not None and last_run.date() >= today:
+            return {'deleted': 0, 'downsampled': 0}
+
+        deleted = 0
+        if settings.RANK_HISTORY_RETENTION_DAYS > 0:
+            deleted = self.session.query(RankHistory).filter(
+                RankHistory.date < today - timedelta(days=settings.RANK_HISTORY_RETENTION_DAYS)
+            ).delete(synchronize_session=False)
+
+        cutoff = self._rank_history_cutoff(today)
+        query = self.session.query(func.min(RankHistory.date)).filter(
+            RankHistory.date < cutoff, func.strftime('%w', RankHistory.date) != '1'
+        )
+        if last_run is not None:
+            # 上次压缩之前的行都已经是周一的行
+            query = query.filter(RankHistory.date >= self._rank_history_cutoff(last_run.date()))
+        first = query.scalar()
+        downsampled = 0
+        if first is not None:
+            start = first - timedelta(days=first.weekday())
+            query = self.session.query(RankHistory).filter(
+                RankHistory.date >= start, RankHistory.date < cutoff
+            )
+            weekly = dict()
+            rows = query.with_entities(
+                RankHistory.keyword, RankHistory.date, RankHistory.product_id,
+                RankHistory.position
+            ).all()
+            for keyword, day, product_id, position in rows:
+                key = (keyword, day - timedelta(days=day.weekday()), product_id)
+                if key not in weekly or position < weekly[key]:
+                    weekly[key] = position
+            query.delete(synchronize_session=False)
+            self._insert_rank_history([{
+                'keyword': keyword, 'date': day, 'product_id': product_id, 'position': position,
+            } for (keyword, day, product_id), position in weekly.items()])
+            downsampled = len(rows) - len(weekly)
+        self.set_last_run('rank_history_compact', datetime.combine(today, datetime.min.time()))
+        return {'deleted': deleted, 'downsampled': downsampled}
+
+    @staticmethod
+    def _rank_history_cutoff(today):
+        """the Monday before which rows are downsampled to weekly rows."""
+        cutoff = today - timedelta(days=settings.RANK_HISTORY_DAILY_DAYS)
+        return cutoff - timedelta(days=cutoff.weekday())
+
+    def get_keywords_info(self):
+        """Get the overview information of all keywords with one query.
+
+        Returns:
+            dict: normalized keyword to a tuple (is_p4p_keyword, company_cnt, showwin_cnt,
+                srh_pv_this_mon).
+        """
+        query_result = self.session.query(
+            Keyword.value_norm, Keyword.is_p4p_keyword, Keyword.company_cnt, Keyword.showwin_cnt,
+            Keyword.srh_pv_this_mon
+        ).all()
+        return {q[0]: tuple(q[1:]) for q in query_result}
+
     def get_valid_keywords(self):
         valid_keywords = self.get_product_keywords()
         
         category_regex = re.compile(settings.REG_CATEGORIES)
-        all_keywords = self.get_all_keywords()
-        for keyword in all_keywords:
-            if self.is_negative_keyword(keyword.value) or \
-               not category_regex.search(str(keyword.category)):
-               continue
-            valid_keywords.append(keyword.value)
+        category_keywords = [
+            value for value, category in self.iter_keywords('category')
+            if category_regex.search(str(category))
+        ]
+        valid_keywords.extend(self.filter_negative(category_keywords))
 
         return sorted(set(valid_keywords))
 
+    def get_craw_keywords(self):
+        """return the sorted product keywords and base file keywords."""
+        keywords = self.get_product_keywords()
+        keywords.extend(self.get_base_file_keywords())
+        return sorted(set(keywords))
+
     def get_base_file_keywords(self):
         base_keywords = None
         with open(settings.BASE_KEYWORDS_FILE, 'r', encoding='utf-8') as f:
@@ -280,26 +785,367 @@ class Database():
             base_keywords = filter(partial(is_not, None), base_keywords)
             return base_keywords
 
-    def close(self):
+    @timed('spider_db_write')
+    def add_frontier_requests(self, items):
+        """insert frontier requests, the request with an existing fingerprint is ignored.
+
+        Args:
+            items (list): a list of dict contains fingerprint, kind, task and priority.
+        """
+        if items is None or len(items) == 0:
+            return
+        self.session.execute(FrontierRequest.__table__.insert().prefix_with('OR IGNORE'), items)
         self.session.commit()
-        self.session.close()
 
-    def get_negative_keyword_rules(self):
-        negative_keywords = list()
-        with open(settings.NEGATIVE_KEYWORDS_FILE, 'r', encoding='utf-8') as f:
-            for line in f:
-                if line.startswith('#'):
+    def has_unfinished_frontier_requests(self, kind):
+        return self.session.query(FrontierRequest).filter(
+            FrontierRequest.kind == kind, FrontierRequest.status != 'done'
+        ).count() > 0
+
+    def reset_frontier(self, kind):
+        """Delete all frontier requests of the kind."""
+        self.session.query(FrontierRequest).filter_by(kind=kind).delete()
+        self.session.commit()
+
+    @timed('spider_db_write')
+    def delete_done_frontier_requests(self, kind, before):
+        """delete the done frontier requests of the kind finished before a time.
+
+        Their fingerprints no longer block the same requests added by a later run.
+
+        Args:
+            kind (str): the request kind.
+            before (datetime): requests finished before it are deleted, including the requests
+                finished by an older version which didn't record the time.
+
+        Returns:
+            int: the count of deleted requests.
+        """
+        count = self.session.query(FrontierRequest).filter(
+            FrontierRequest.kind == kind, FrontierRequest.status == 'done',
+            or_(FrontierRequest.finished.is_(None), FrontierRequest.finished < before)
+        ).delete(synchronize_session=False)
+        self.session.commit()
+        return count
+
+    @timed('spider_db_write')
+    def reclaim_frontier_leases(self, kind):
+        """make the leased frontier requests of the kind pending again.
+
+        The requests leased by a crashed process are available at once instead of after their
+        lease expires. Only safe when no other process is crawling the kind.
+
+        Returns:
+            int: the count of reclaimed requests.
+        """
+        count = self.session.query(FrontierRequest).filter(
+            FrontierRequest.kind == kind, FrontierRequest.status == 'leased'
+        ).update({
+            FrontierRequest.status: 'pending', FrontierRequest.lease_until: None
+        }, synchronize_session=False)
+        self.session.commit()
+        return count
+
+    def _query_available_frontier_requests(self, kind):
+        return self.session.query(FrontierRequest).filter(
+            FrontierRequest.kind == kind,
+            or_(
+                FrontierRequest.status == 'pending',
+                and_(
+                    FrontierRequest.status == 'leased',
+                    FrontierRequest.lease_until < datetime.now()
+                )
+            )
+        )
+
+    def count_available_frontier_requests(self, kind):
+        """count pending requests and requests whose lease is expired."""
+        return self._query_available_frontier_requests(kind).count()
+
+    @timed('spider_db_write')
+    def lease_frontier_requests(self, kind, limit, lease_seconds):
+        """lease available frontier requests by priority and insertion order.
+
+        Args:
+            kind (str): the request kind.
+            limit (int): max count of requests.
+            lease_seconds (int): the request is available again after lease expired.
+
+        Returns:
+            list: leased FrontierRequest objects.
+        """
+        items = self._query_available_frontier_requests(kind).order_by(
+            FrontierRequest.priority.desc(), FrontierRequest.id
+        ).limit(limit).all()
+        lease_until = datetime.now() + timedelta(seconds=lease_seconds)
+        for item in items:
+            item.status = 'leased'
+            item.lease_until = lease_until
+        self.session.commit()
+        return items
+
+    @timed('spider_db_write')
+    def extend_frontier_leases(self, items, lease_seconds):
+        """renew the lease of leased frontier requests from now."""
+        if items is None or len(items) == 0:
+            return
+        lease_until = datetime.now() + timedelta(seconds=lease_seconds)
+        for item in items:
+            item.lease_until = lease_until
+        self.session.commit()
+
+    @timed('spider_db_write')
+    def finish_frontier_requests(self, items):
+        finished = datetime.now()
+        for item in items:
+            item.status = 'done'
+            item.lease_until = None
+            item.finished = finished
+        self.session.commit()
+
+    @timed('spider_db_write')
+    def release_frontier_request(self, item, failed=True):
+        """make a leased frontier request available again.
+
+        Args:
+            item (FrontierRequest): the leased request.
+            failed (bool): the request failed, count it as an attempt.
+        """
+        item.status = 'pending'
+        item.lease_until = None
+        if failed:
+            item.attempts += 1
+        self.session.commit()
+
+    @timed('spider_db_write')
+    def bury_frontier_request(self, item, error):
+        """move a failed frontier request to the dead letters table.
+
+        Args:
+            item (FrontierRequest): the leased request.
+            error (str): the last error.
+        """
+        self.session.execute(DeadLetter.__table__.insert().prefix_with('OR REPLACE'), [{
+            'fingerprint': item.fingerprint,
+            'kind': item.kind,
+            'task': item.task,
+            'priority': item.priority,
+            'attempts': item.attempts + 1,
+            'error': error,
+            'created': datetime.now(),
+        }])
+        self.session.delete(item)
+        self.session.commit()
+
+    def get_dead_letters(self, kind=None):
+        """return DeadLetter objects of the kind, all kinds if kind is None."""
+        query = self.session.query(DeadLetter)
+        if kind is not None:
+            query = query.filter(DeadLetter.kind == kind)
+        return query.order_by(DeadLetter.id).all()
+
+    def requeue_dead_letters(self, kind=None):
+        """move dead letters back to the frontier as pending requests with no attempt.
+
+        The next craw of the kind continues with them.
+
+        Returns:
+            int: the count of requeued requests.
+        """
+        letters = self.get_dead_letters(kind)
+        self.add_frontier_requests([{
+            'fingerprint': x.fingerprint,
+            'kind': x.kind,
+            'task': x.task,
+            'priority': x.priority,
+        } for x in letters])
+        for letter in letters:
+            self.session.delete(letter)
+        self.session.commit()
+        return len(letters)
+
+    def migrate(self):
+        """Convert the data of an existing database to the current storage format.
+
+        Returns:
+            dict: the count of converted rows of each step.
+        """
+        return {
+            'array_columns': self._migrate_array_columns(),
+            'keyword_norm': self._migrate_keyword_norm(),
+            'rank_history': self._migrate_rank_history(),
+            'srh_pv_columns': self._migrate_srh_pv_columns(),
+        }
+
+    def _migrate_array_columns(self):
+        """re-encode JSONEncodedList columns still stored as python literal to json."""
+        count = 0
+        for table in BASE.metadata.sorted_tables:
+            for column in table.columns:
+                if not isinstance(column.type, JSONEncodedList):
                     continue
-                line = line.strip()
-                line = line[1:-1] if line.startswith('/') and line.endswith('/') else '^%s$'%line
-                regex = re.compile(line)
-                negative_keywords.append(regex)
-        return negative_keywords
+                rows = self.session.execute(text(
+                    'SELECT rowid, "%s" FROM "%s" WHERE "%s" IS NOT NULL' % (
+                        column.name, table.name, column.name)
+                )).fetchall()
+                params = list()
+                for rowid, value in rows:
+                    try:
+                        json.loads(value)
+                    except ValueError:
+                        params.append({
+                            'b_rowid': rowid,
+                            'b_value': ARRAY_TYPE.process_bind_param(decode_list(value), None),
+                        })
+                statement = text('UPDATE "%s" SET "%s" = :b_value WHERE rowid = :b_rowid' % (
+                    table.name, column.name))
+                for i in range(0, len(params), settings.DATABASE_BATCH_SIZE):
+                    self.session.execute(statement, params[i:i+settings.DATABASE_BATCH_SIZE])
+                self.session.commit()
+                count += len(params)
+        return count
+
+    def _fill_keyword_norm(self):
+        """fill Keyword.value_norm of the rows without it, no row is merged or deleted.
+
+        Returns:
+            int: the count of normalized values shared by several keywords, the migrate
+                command merges them.
+        """
+        values = self.session.query(Keyword.value).filter(Keyword.value_norm.is_(None)).all()
+        params = [{'b_value': x, 'b_value_norm': normalize_keyword(x)} for x, in values]
+        statement = Keyword.__table__.update().where(
+            Keyword.value == bindparam('b_value')).values(value_norm=bindparam('b_value_norm'))
+        for i in range(0, len(params), settings.DATABASE_BATCH_SIZE):
+            self.session.execute(statement, params[i:i+settings.DATABASE_BATCH_SIZE])
+        self.session.commit()
+        return self.session.query(Keyword.value_norm).group_by(Keyword.value_norm).having(
+            func.count(Keyword.value) > 1).count()
+
+    def _migrate_keyword_norm(self):
+        """fill Keyword.value_norm and normalize Rank.keyword.
+
+        Keywords or ranks which only differ in case or spacing are merged, the most recently
+        updated row is kept. A keyword column that is null in the kept row is filled from the
+        merged rows, the most recently updated first.
+        """
+        count = 0
+        keywords = self.session.query(Keyword.value, Keyword.value_norm, Keyword.update).all()
+        groups = dict()
+        for value, value_norm, update in keywords:
+            groups.setdefault(normalize_keyword(value), list()).append((value, value_norm, update))
+        deleted, updated, merged = (list(), list(), list())
+        for norm, rows in groups.items():
+            rows.sort(key=lambda x: (x[2] is not None, x[2]), reverse=True)
+            deleted.extend(x[0] for x in rows[1:])
+            if len(rows) > 1:
+                merged.append([x[0] for x in rows])
+            if rows[0][1] != norm:
+                updated.append({'b_value': rows[0][0], 'b_value_norm': norm})
+        self._merge_keyword_columns(merged)
+        self._delete_in_chunks(Keyword.value, deleted)
+        if len(updated) > 0:
+            self.session.execute(Keyword.__table__.update().where(
+                Keyword.value == bindparam('b_value')).values(value_norm=bindparam('b_value_norm')),
+                updated)
+        count += len(deleted) + len(updated)
+
+        groups = dict()
+        for keyword, update in self.session.query(Rank.keyword, Rank.update).all():
+            groups.setdefault(normalize_keyword(keyword), list()).append((keyword, update))
+        deleted, renamed = (list(), list())
+        for norm, rows in groups.items():
+            rows.sort(key=lambda x: (x[1] is not None, x[1], x[0] == norm), reverse=True)
+            deleted.extend(x[0] for x in rows[1:])
+            if rows[0][0] != norm:
+                renamed.append({'b_keyword': rows[0][0], 'b_norm': norm})
+        self._delete_in_chunks(Rank.keyword, deleted)
+        if len(renamed) > 0:
+            self.session.execute(Rank.__table__.update().where(
+                Rank.keyword == bindparam('b_keyword')).values(keyword=bindparam('b_norm')),
+                renamed)
+        count += len(deleted) + len(renamed)
+        self.session.commit()
+        return count
+
+    def _merge_keyword_columns(self, groups):
+        """fill the null columns of the first keyword of each group from the other keywords.
+
+        Args:
+            groups (list): lists of keyword values, the first one is kept.
+        """
+        columns = [x.key for x in Keyword.__table__.columns
+                   if x.key not in ['value', 'value_norm', 'update']]
+        values = [x for group in groups for x in group]
+        records = dict()
+        for i in range(0, len(values), 500):
+            records.update((x.value, x) for x in self.session.query(Keyword).filter(
+                Keyword.value.in_(values[i:i+500])))
+        for group in groups:
+            kept = records[group[0]]
+            for record in [records[x] for x in group[1:]]:
+                for column in columns:
+                    if getattr(kept, column) is None and getattr(record, column) is not None:
+                        setattr(kept, column, getattr(record, column))
+        self.session.flush()
+
+    def _delete_in_chunks(self, column, values):
+        for i in range(0, len(values), 500):
+            self.session.query(column.class_).filter(
+                column.in_(values[i:i+500])
+            ).delete(synchronize_session=False)
+
+    def _migrate_rank_history(self):
+        """add the current rank rows to rank_history, existing history rows are kept."""
+        history = list()
+        for keyword, ranking, update in self.session.query(Rank.keyword, Rank.ranking, Rank.update):
+            for x in ranking or []:
+                history.append({
+                    'keyword': keyword,
+                    'date': update or date.today(),
+                    'product_id': x['product_id'],
+                    'position': RankHistory.encode_position(x['ranking']),
+                })
+        count = self._insert_rank_history(history, prefix='OR IGNORE')
+        self.session.commit()
+        return count
+
+    def _migrate_srh_pv_columns(self):
+        """move the former json srh_pv column of keywords to the srh_pv integer columns.
+
+        The json column can not be dropped by older SQLite, it is set to NULL instead.
+        """
+        if 'srh_pv' not in self._get_table_columns(Keyword.__tablename__):
+            return 0
+        rows = self.session.execute(text(
+            'SELECT rowid, srh_pv FROM keywords WHERE srh_pv IS NOT NULL')).fetchall()
+        statement = text('UPDATE keywords SET %s, srh_pv = NULL WHERE rowid = :b_rowid' % (
+            ', '.join('"%s" = :%s' % (x, x) for x in SRH_PV_KEYS)))
+        params = list()
+        for rowid, value in rows:
+            srh_pv = json.loads(value)
+            param = {x: srh_pv.get(x) for x in SRH_PV_KEYS}
+            param['b_rowid'] = rowid
+            params.append(param)
+        for i in range(0, len(params), settings.DATABASE_BATCH_SIZE):
+            self.session.execute(statement, params[i:i+settings.DATABASE_BATCH_SIZE])
+        self.session.commit()
+        return len(params)
+
+    def close(self):
+        self.session.commit()
+        self.session.close()
 
     def is_negative_keyword(self, keyword):
-        if keyword is None or keyword == '':
-            return True
-        for rule in self.get_negative_keyword_rules():
-            if rule.search(keyword.strip()):
-                return True
-        return False
+        return self.negative_keyword_matcher.is_negative(keyword)
+
+    def filter_negative(self, keywords):
+        """Remove negative keywords.
+
+        Args:
+            keywords (iterable): keywords to be filtered.
+
+        Returns:
+            list: keywords which are not negative, in the same order.
+        """
+        return self.negative_keyword_matcher.filter_negative(keywords)
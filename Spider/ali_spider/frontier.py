@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+"""frontier
+
+持久化的请求队列，替代原来的内存 RequestManager。
+
+请求以指纹去重并保存在数据库中，进程中断或被封后再次运行时会从未完成的请求继续。
+"""
+
+import json
+import hashlib
+from datetime import date, datetime
+from urllib.parse import urlsplit, parse_qsl
+import settings
+
+# 每次会话都会变化的参数，不参与指纹计算
+_VOLATILE_PARAMS = {'ctoken', '_csrf_token_', 'dmtrack_pageid', '_'}
+
+def fingerprint(request):
+    """计算请求的指纹。
+
+    指纹由 method、url、排序后的 params 和 form data 组成，不包括 token 等会话参数，
+    也不包括 rank 请求 url 中的随机数。
+
+    Args:
+        request (requests.Request): 需要计算指纹的请求。
+
+    Returns:
+        str: 请求指纹。
+    """
+    scheme, netloc, path, query, _ = urlsplit(request.url)
+    # parse_qsl 会忽略没有 "=" 的随机数
+    params = parse_qsl(query) + list((request.params or {}).items())
+    data = list((request.data or {}).items())
+    canonical = json.dumps([
+        request.method.upper(),
+        '%s://%s%s' % (scheme, netloc.lower(), path),
+        sorted([k, str(v)] for k, v in params if k not in _VOLATILE_PARAMS),
+        sorted([k, str(v)] for k, v in data if k not in _VOLATILE_PARAMS),
+    ])
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+class Frontier():
+    """持久化的请求队列。
+
+    队列中保存的是创建请求的参数 task，取出时再用 builder 创建请求，这样恢复运行时会使用新的 token。
+    如果某类请求没有未完成的记录，则认为是一次新的爬取并清空旧记录，否则从未完成的记录继续，
+    并删除今天以前完成的记录，以免它们的指纹阻止今天需要重新爬取的请求。
+    作为 context manager 使用时，退出时会放回未完成的租用请求，下次运行可以立即继续；
+    进程崩溃时未放回的请求在下次创建 Frontier 时收回。
+    多次失败的请求移入 dead letter 表，不再阻塞爬取。
+
+    Args:
+        database (Database): 数据库对象。
+        kind (str): 请求类型，例如 'keyword'、'rank'。
+        builder (callable): 以 task 为关键字参数创建 requests.Request 的函数。
+    """
+
+    def __init__(self, database, kind, builder):
+        self.database = database
+        self.kind = kind
+        self.builder = builder
+        self.leased = dict()
+        self.resumed = database.has_unfinished_frontier_requests(kind)
+        if not self.resumed:
+            database.reset_frontier(kind)
+        else:
+            # 爬虫是单进程的，租用中的请求属于已中断的进程，不需要等待租约过期
+            database.reclaim_frontier_leases(kind)
+            database.delete_done_frontier_requests(
+                kind, before=datetime.combine(date.today(), datetime.min.time()))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for item in list(self.leased.values()):
+            self.leased.pop(item.id, None)
+            self.database.release_frontier_request(item, failed=False)
+
+    def add_request(self, task, priority=0):
+        """添加请求到队列中，已存在的请求会被忽略。"""
+        self.add_requests([task], priority=priority)
+
+    def add_requests(self, tasks, priority=0):
+        """批量添加请求到队列中。"""
+        if tasks is None or len(tasks) == 0:
+            return
+        items = [{
+            'fingerprint': fingerprint(self.builder(**task)),
+            'kind': self.kind,
+            'task': task,
+            'priority': priority,
+        } for task in tasks]
+        self.database.add_frontier_requests(items)
+
+    def has_request(self):
+        """是否存在可处理的请求"""
+        return self.database.count_available_frontier_requests(self.kind) != 0
+
+    def get_request(self):
+        """从队列中租用一个请求，请求在发送前用 builder(**item.task) 创建
+
+        Returns:
+            FrontierRequest: 租用的请求，队列为空时返回 None。
+        """
+        leased = self.get_requests(1)
+        return leased[0] if len(leased) > 0 else None
+
+    def get_requests(self, limit):
+        """按优先级和添加顺序租用多个请求，返回 FrontierRequest 列表"""
+        # 重试和熔断等待可能超过租约，先延长仍在处理的请求的租约，以免再次租用它们
+        self.database.extend_frontier_leases(
+            list(self.leased.values()), settings.FRONTIER_LEASE_SECONDS)
+        items = self.database.lease_frontier_requests(
+            self.kind, limit=limit, lease_seconds=settings.FRONTIER_LEASE_SECONDS
+        )
+        self.leased.update((item.id, item) for item in items)
+        return items
+
+    def done(self, item):
+        """标记请求已完成"""
+        self.done_all([item])
+
+    def done_all(self, items):
+        """批量标记请求已完成"""
+        for item in items:
+            self.leased.pop(item.id, None)
+        self.database.finish_frontier_requests(items)
+
+    def release(self, item):
+        """放回请求，稍后重试"""
+        self.leased.pop(item.id, None)
+        self.database.release_frontier_request(item)
+
+    def fail(self, item, error):
+        """请求失败，失败次数未达到 FRONTIER_MAX_ATTEMPTS 时放回队列，否则移入 dead letter 表
+
+        Returns:
+            bool: True 表示会重试，False 表示已移入 dead letter 表。
+        """
+        if item.attempts + 1 < settings.FRONTIER_MAX_ATTEMPTS:
+            self.release(item)
+            return True
+        self.leased.pop(item.id, None)
+        self.database.bury_frontier_request(item, error=str(error))
+        return False
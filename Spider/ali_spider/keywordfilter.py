@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+"""keywordfilter
+
+否定关键词匹配模块。
+
+规则文件每行一条规则，以 # 开头的行为注释。/regex/ 形式的规则为正则表达式，
+其他规则为完整匹配。
+"""
+
+import os
+import re
+
+_REGEX_META = re.compile(r'[.^$*+?{}\[\]\\|()]')
+# 编号的反向引用，如 \1，前面的反斜杠不是转义的反斜杠
+_NUMBERED_BACKREF = re.compile(r'(?<!\\)(?:\\\\)*\\[1-9]')
+
+class NegativeKeywordMatcher():
+    """否定关键词匹配器。
+
+    规则只加载一次，规则文件修改时间变化时才重新加载。完整匹配的规则保存在集合中，
+    正则规则合并为一个表达式，合并后组号会变化，含有编号反向引用的规则单独编译。
+
+    Args:
+        path (str): 规则文件路径。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.exact_rules = set()
+        self.pattern = None
+
+    def _reload(self):
+        mtime = os.path.getmtime(self.path)
+        if mtime == self.mtime:
+            return
+        exact_rules = set()
+        regex_rules = list()
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('#'):
+                    continue
+                line = line.strip()
+                if line.startswith('/') and line.endswith('/') and len(line) > 1:
+                    regex_rules.append(line[1:-1])
+                elif _REGEX_META.search(line) is None:
+                    exact_rules.add(line)
+                else:
+                    # 含有正则元字符的完整匹配规则
+                    regex_rules.append('^%s$' % line)
+        self.exact_rules = exact_rules
+        self.pattern = self._compile(regex_rules)
+        self.mtime = mtime
+
+    @staticmethod
+    def _compile(regex_rules):
+        if len(regex_rules) == 0:
+            return None
+        combined = [x for x in regex_rules if _NUMBERED_BACKREF.search(x) is None]
+        separate = [re.compile(x) for x in regex_rules if _NUMBERED_BACKREF.search(x) is not None]
+        if len(combined) > 0:
+            try:
+                combined = [re.compile('|'.join('(?:%s)' % x for x in combined))]
+            except re.error:
+                # 规则中含有不能合并的写法（如内联 flag），逐条编译
+                combined = [re.compile(x) for x in combined]
+        rules = combined + separate
+        return rules[0] if len(rules) == 1 else _RuleList(rules)
+
+    def is_negative(self, keyword):
+        """判断关键词是否为否定关键词，空关键词为否定关键词"""
+        if keyword is None or keyword == '':
+            return True
+        self._reload()
+        return self._match(keyword.strip())
+
+    def _match(self, keyword):
+        if keyword in self.exact_rules:
+            return True
+        return self.pattern is not None and self.pattern.search(keyword) is not None
+
+    def filter_negative(self, keywords):
+        """过滤否定关键词
+
+        Args:
+            keywords (iterable): 关键词列表。
+
+        Returns:
+            list: 不是否定关键词的关键词列表，顺序不变。
+        """
+        self._reload()
+        return [x for x in keywords if x is not None and x != '' and not self._match(x.strip())]
+
+class _RuleList():
+    """逐条匹配的规则列表，接口与编译后的正则表达式相同"""
+
+    def __init__(self, rules):
+        self.rules = rules
+
+    def search(self, keyword):
+        for rule in self.rules:
+            result = rule.search(keyword)
+            if result is not None:
+                return result
+        return None
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+
+"""metrics
+
+抓取过程的计数器和耗时直方图。
+
+请求、解析和数据库写入都记录到模块级的 REGISTRY 中，每次运行结束时导出为 JSON 汇总，
+长时间运行时由 TextfileExporter 定期写入 Prometheus textfile (node_exporter 的
+textfile collector 可以读取)。
+"""
+
+import os
+import json
+import time
+import threading
+from functools import wraps
+
+# 直方图的桶上限，单位为秒
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+class Histogram():
+    """固定桶的直方图，不是线程安全的，由 Registry 加锁"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """根据桶估计分位数，桶内线性插值"""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, self.counts):
+            if count > 0 and cumulative + count >= rank:
+                upper = min(bound, self.max)
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = bound
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'mean': round(self.sum / self.count, 6) if self.count else 0.0,
+            'p50': round(self.quantile(0.5), 6),
+            'p90': round(self.quantile(0.9), 6),
+            'p99': round(self.quantile(0.99), 6),
+            'max': round(self.max, 6),
+        }
+
+class Registry():
+    """按名称和标签保存计数器和直方图"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = dict()
+        self.histograms = dict()
+        self.started = time.time()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """计数器 name 增加 value"""
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """向直方图 name 记录一个值"""
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.started = time.time()
+
+    def to_dict(self):
+        """JSON 汇总，每个指标是 {labels, value} 或 {labels, count, sum, ...} 的列表"""
+        with self.lock:
+            counters = dict()
+            for (name, labels), value in sorted(self.counters.items()):
+                counters.setdefault(name, list()).append({'labels': dict(labels), 'value': value})
+            histograms = dict()
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                item = {'labels': dict(labels)}
+                item.update(histogram.summary())
+                histograms.setdefault(name, list()).append(item)
+        return {
+            'started': self.started,
+            'elapsed': round(time.time() - self.started, 3),
+            'counters': counters,
+            'histograms': histograms,
+        }
+
+    def format_prometheus(self):
+        """Prometheus 文本格式"""
+        lines = list()
+        with self.lock:
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append('# TYPE %s counter' % name)
+                    typed.add(name)
+                lines.append('%s%s %s' % (name, _format_labels(labels), value))
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append('# TYPE %s histogram' % name)
+                    typed.add(name)
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('%s_bucket%s %d' % (
+                        name, _format_labels(labels + (('le', le),)), cumulative))
+                lines.append('%s_sum%s %r' % (name, _format_labels(labels), histogram.sum))
+                lines.append('%s_count%s %d' % (name, _format_labels(labels), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, path, **info):
+        """写入 JSON 汇总，info 为附加的运行信息"""
+        summary = dict(info)
+        summary.update(self.to_dict())
+        _write_atomic(path, json.dumps(summary, indent=2, ensure_ascii=False))
+
+    def write_prometheus(self, path):
+        _write_atomic(path, self.format_prometheus())
+
+def _format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                             for k, v in labels)
+
+def _write_atomic(path, content):
+    # 先写临时文件再替换，读取方不会读到写了一半的文件
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp_path, 'w', encoding='utf-8') as temp_file:
+        temp_file.write(content)
+    os.replace(temp_path, path)
+
+REGISTRY = Registry()
+
+def timed(name):
+    """装饰器，函数耗时记录到直方图 `name`_seconds，异常记录到计数器 `name`_errors_total，
+    标签 function 为函数名"""
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                REGISTRY.inc(name + '_errors_total', function=func.__name__,
+                             error=type(e).__name__)
+                raise
+            finally:
+                REGISTRY.observe(name + '_seconds', time.perf_counter() - start,
+                                 function=func.__name__)
+        return wrapper
+    return decorator
+
+class TextfileExporter():
+    """每隔 interval 秒把 REGISTRY 写入 Prometheus textfile，退出时再写一次
+
+    Args:
+        path (str): textfile 路径，为空时不导出。
+        interval (float): 导出间隔秒数。
+    """
+
+    def __init__(self, path, interval=60):
+        self.path = path
+        self.interval = max(interval, 1)
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        if self.path:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            REGISTRY.write_prometheus(self.path)
+        return False
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            REGISTRY.write_prometheus(self.path)
@@ -3,10 +3,9 @@
 import json
 import ast
 from datetime import date
-from sqlalchemy import Integer, String, Date, DateTime, Boolean, Column
+from sqlalchemy import Integer, String, Date, DateTime, Boolean, Column, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.types import TypeDecorator, VARCHAR
-from sqlalchemy.ext.mutable import MutableDict
 
 class JSONEncodedDict(TypeDecorator):
     """Represents an immutable structure as a json-encoded string.
@@ -28,28 +27,40 @@ class JSONEncodedDict(TypeDecorator):
             value = json.loads(value)
         return value
 
-class Array(TypeDecorator):
-    """Represents an immutable structure as a json-encoded string.
+class JSONEncodedList(TypeDecorator):
+    """Represents an immutable list as a compact json-encoded string.
+
+    Values written by the former python literal encoding are still readable, run
+    ``spider.py migrate`` to convert them.
 
     Usage::
-        JSONEncodedDict(255)
+        JSONEncodedList()
     """
 
     impl = VARCHAR
 
     def process_bind_param(self, value, dialect):
         if value is not None:
-            value = str(value)
+            value = json.dumps(value, separators=(',', ':'), ensure_ascii=False)
 
         return value
 
     def process_result_value(self, value, dialect):
         if value is not None:
-            value = ast.literal_eval(value)
+            value = decode_list(value)
         return value
 
-ARRAY_TYPE = Array()
-JSON_TYPE = MutableDict.as_mutable(JSONEncodedDict)
+def decode_list(value):
+    """decode a JSONEncodedList value, fallback to the former python literal encoding."""
+    try:
+        return json.loads(value)
+    except ValueError:
+        return ast.literal_eval(value)
+
+ARRAY_TYPE = JSONEncodedList()
+
+# 热搜度列，从本月到 11 个月前
+SRH_PV_KEYS = ['srh_pv_this_mon'] + ['srh_pv_last_%dmon' % i for i in range(1, 12)]
 
 BASE = declarative_base()
 
@@ -64,23 +75,56 @@ class Product(BASE):
     keywords = Column('keywords', ARRAY_TYPE)
     owner = Column('owner', String)
     modify_time = Column('modify_time', Date)
-    update = Column('update', Date, default=date.today)
+    update = Column('update', Date, default=date.today, index=True)
     is_trade_product = Column('is_trade_product', Boolean)
     is_window_product = Column('is_window_product', Boolean)
 
+class ProductKeyword(BASE):
+    """Normalized keyword of a product, maintained with the products table."""
+
+    __tablename__ = "product_keywords"
+
+    product_id = Column('product_id', Integer, primary_key=True, autoincrement=False)
+    keyword_norm = Column('keyword_norm', String, primary_key=True, index=True)
+
 class Keyword(BASE):
     """docstring for Keyword."""
 
     __tablename__ = "keywords"
 
     value = Column('value', String, primary_key=True, autoincrement=False)
+    value_norm = Column('value_norm', String, index=True)
     repeat_keyword = Column('repeat_keyword', String)
     company_cnt = Column('company_cnt', Integer)
     showwin_cnt = Column('showwin_cnt', Integer)
-    srh_pv = Column('srh_pv', JSON_TYPE)
-    update = Column('update', DateTime)
+    update = Column('update', DateTime, index=True)
     is_p4p_keyword = Column('is_p4p_keyword', Boolean)
     category = Column('category', ARRAY_TYPE)
+    srh_pv_this_mon = Column('srh_pv_this_mon', Integer, index=True)
+    srh_pv_last_1mon = Column('srh_pv_last_1mon', Integer)
+    srh_pv_last_2mon = Column('srh_pv_last_2mon', Integer)
+    srh_pv_last_3mon = Column('srh_pv_last_3mon', Integer)
+    srh_pv_last_4mon = Column('srh_pv_last_4mon', Integer)
+    srh_pv_last_5mon = Column('srh_pv_last_5mon', Integer)
+    srh_pv_last_6mon = Column('srh_pv_last_6mon', Integer)
+    srh_pv_last_7mon = Column('srh_pv_last_7mon', Integer)
+    srh_pv_last_8mon = Column('srh_pv_last_8mon', Integer)
+    srh_pv_last_9mon = Column('srh_pv_last_9mon', Integer)
+    srh_pv_last_10mon = Column('srh_pv_last_10mon', Integer)
+    srh_pv_last_11mon = Column('srh_pv_last_11mon', Integer)
+
+    @property
+    def srh_pv(self):
+        """dict: SRH_PV_KEYS to the search volume, None if there is no search volume."""
+        values = [getattr(self, x) for x in SRH_PV_KEYS]
+        if all(x is None for x in values):
+            return None
+        return dict(zip(SRH_PV_KEYS, values))
+
+    @srh_pv.setter
+    def srh_pv(self, value):
+        for key in SRH_PV_KEYS:
+            setattr(self, key, None if value is None else value.get(key))
 
 class Rank(BASE):
     """docstring for Rank."""
@@ -89,7 +133,34 @@ class Rank(BASE):
 
     keyword = Column('keyword', String, primary_key=True, autoincrement=False)
     ranking = Column('ranking', ARRAY_TYPE)
-    update = Column('update', Date, default=date.today)
+    update = Column('update', Date, default=date.today, index=True)
+
+class RankHistory(BASE):
+    """Append-only rank history, one row per keyword, date and product.
+
+    The position is stored as an integer pageNO * 100 + rowNO, see encode_position. Rows older
+    than `RANK_HISTORY_DAILY_DAYS` are downsampled to one row per week, dated on Monday.
+    """
+
+    __tablename__ = "rank_history"
+    __table_args__ = (
+        Index('ix_rank_history_product_id_date', 'product_id', 'date'),
+        Index('ix_rank_history_date', 'date'),
+    )
+
+    keyword = Column('keyword', String, primary_key=True, autoincrement=False)
+    date = Column('date', Date, primary_key=True, autoincrement=False)
+    product_id = Column('product_id', Integer, primary_key=True, autoincrement=False)
+    position = Column('position', Integer)
+
+    @staticmethod
+    def encode_position(ranking):
+        """encode a ranking such as 1.05 (page 1, row 5) to 105"""
+        return int(round(ranking * 100))
+
+    @staticmethod
+    def decode_position(position):
+        return position / 100
 
 class P4P(BASE):
     __tablename__ = "p4p"
@@ -98,3 +169,40 @@ class P4P(BASE):
     qs_star = Column('qs_star', Integer)
     is_start = Column('is_start', Boolean)
     tag = Column('tag', ARRAY_TYPE)
+
+class JobRun(BASE):
+    """Last completion time of a periodic job, such as the product id pass."""
+
+    __tablename__ = "job_runs"
+
+    name = Column('name', String, primary_key=True)
+    finished = Column('finished', DateTime)
+
+class FrontierRequest(BASE):
+    """Persistent crawl request, see frontier.Frontier."""
+
+    __tablename__ = "frontier"
+
+    id = Column('id', Integer, primary_key=True)
+    fingerprint = Column('fingerprint', String, unique=True)
+    kind = Column('kind', String, index=True)
+    task = Column('task', JSONEncodedDict)
+    priority = Column('priority', Integer, default=0)
+    status = Column('status', String, default='pending')
+    lease_until = Column('lease_until', DateTime)
+    attempts = Column('attempts', Integer, default=0)
+    finished = Column('finished', DateTime)
+
+class DeadLetter(BASE):
+    """Frontier request failed FRONTIER_MAX_ATTEMPTS times, see frontier.Frontier.fail."""
+
+    __tablename__ = "dead_letters"
+
+    id = Column('id', Integer, primary_key=True)
+    fingerprint = Column('fingerprint', String, unique=True)
+    kind = Column('kind', String, index=True)
+    task = Column('task', JSONEncodedDict)
+    priority = Column('priority', Integer, default=0)
+    attempts = Column('attempts', Integer, default=0)
+    error = Column('error', String)
+    created = Column('created', DateTime)
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+
+"""normalizer
+
+关键词规范化模块，所有关键词比较都应使用 normalize_keyword。
+"""
+
+import re
+from functools import lru_cache
+
+_SPACES = re.compile(' +')
+
+@lru_cache(maxsize=65536)
+def normalize_keyword(keyword):
+    """规范化关键词：转为小写并合并连续空格，结果会被缓存
+
+    Args:
+        keyword (str): 关键词。
+
+    Returns:
+        str: 规范化的关键词。
+    """
+    return _SPACES.sub(' ', keyword.lower())
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+"""pipeline
+
+抓取、解析、写入三段流水线。
+
+抓取在多个线程中进行，解析在一个线程中进行，写入在调用 put 和 join 的线程中批量进行，
+所以数据库 session 和 Frontier 始终只在一个线程中使用。阶段之间是有长度上限的队列，
+写入跟不上时解析和抓取会等待。
+"""
+
+import time
+import queue
+import threading
+
+class PipelineError(Exception):
+    """抓取或解析阶段的异常，原异常为 __cause__"""
+
+class Pipeline():
+    """抓取、解析、写入流水线
+
+    Args:
+        fetch (callable): fetch(task)，返回响应，在抓取线程中调用。
+        parse (callable): parse(task, response)，返回解析结果，在解析线程中调用。
+        write (callable): write(results)，results 为 (task, result) 列表，在调用线程中调用。
+        workers (int): 抓取线程数。
+        queue_size (int): 每个队列的长度上限。
+        batch_size (int): 每次写入的最大结果数。
+    """
+
+    def __init__(self, fetch, parse, write, workers=1, queue_size=20, batch_size=50):
+        self.fetch = fetch
+        self.parse = parse
+        self.write = write
+        self.workers = max(workers, 1)
+        self.batch_size = max(batch_size, 1)
+        self.task_queue = queue.Queue(maxsize=queue_size)
+        self.response_queue = queue.Queue(maxsize=queue_size)
+        self.result_queue = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+        self.threads = list()
+        self.pending = 0
+        self.buffer = list()
+        self.stats_lock = threading.Lock()
+        self.stats = {x: [0, 0.0] for x in ['fetch', 'parse', 'write', 'wait']}
+
+    def __enter__(self):
+        self.threads = [threading.Thread(target=self._fetch_worker, daemon=True)
+                        for _ in range(self.workers)]
+        self.threads.append(threading.Thread(target=self._parse_worker, daemon=True))
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+        return False
+
+    def _count(self, stage, seconds):
+        with self.stats_lock:
+            self.stats[stage][0] += 1
+            self.stats[stage][1] += seconds
+
+    def _get(self, source):
+        while not self.stop_event.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
+
+    def _put(self, target, item):
+        while not self.stop_event.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _fetch_worker(self):
+        while True:
+            task = self._get(self.task_queue)
+            if task is None:
+                return
+            start = time.perf_counter()
+            try:
+                response = self.fetch(task)
+            except Exception as e:
+                self._put(self.result_queue, (task, e, True))
+                continue
+            self._count('fetch', time.perf_counter() - start)
+            self._put(self.response_queue, (task, response))
+
+    def _parse_worker(self):
+        while True:
+            item = self._get(self.response_queue)
+            if item is None:
+                return
+            task, response = item
+            start = time.perf_counter()
+            try:
+                result = self.parse(task, response)
+            except Exception as e:
+                self._put(self.result_queue, (task, e, True))
+                continue
+            self._count('parse', time.perf_counter() - start)
+            self._put(self.result_queue, (task, result, False))
+
+    def put(self, task):
+        """添加任务，队列已满时先写入已完成的结果"""
+        start = time.perf_counter()
+        while True:
+            try:
+                self.task_queue.put(task, timeout=0.05)
+                break
+            except queue.Full:
+                self._drain(block=False)
+        self._count('wait', time.perf_counter() - start)
+        self.pending += 1
+        self._drain(block=False)
+
+    def join(self):
+        """等待所有任务完成并写入"""
+        while self.pending > len(self.buffer):
+            self._drain(block=True)
+        self._flush()
+
+    def _drain(self, block):
+        while self.pending > len(self.buffer):
+            try:
+                task, result, failed = self.result_queue.get(block=block, timeout=0.1)
+            except queue.Empty:
+                if not block:
+                    break
+                continue
+            if failed:
+                # 先写入已完成的结果，再抛出异常
+                self._flush()
+                self.pending -= 1
+                raise PipelineError('%s: %s' % (type(result).__name__, result)) from result
+            self.buffer.append((task, result))
+            if len(self.buffer) >= self.batch_size:
+                self._flush()
+            block = False
+        if not block and len(self.buffer) > 0 and self.result_queue.empty():
+            self._flush()
+
+    def _flush(self):
+        if len(self.buffer) == 0:
+            return
+        results, self.buffer = (self.buffer, list())
+        start = time.perf_counter()
+        self.write(results)
+        self._count('write', time.perf_counter() - start)
+        self.pending -= len(results)
+
+    def format_stats(self):
+        """各阶段的次数、总耗时和平均耗时"""
+        with self.stats_lock:
+            stats = {x: list(y) for x, y in self.stats.items()}
+        return '  '.join('%s %d x %.2fs (%.1f ms)' % (
+            x, stats[x][0], stats[x][1], stats[x][1] * 1000 / max(stats[x][0], 1)
+        ) for x in ['fetch', 'parse', 'write', 'wait'])
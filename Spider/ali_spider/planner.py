@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+"""planner
+
+爬取计划模块，批量判断需要爬取的关键词并估算请求数和耗时。
+"""
+
+from collections import namedtuple
+from normalizer import normalize_keyword
+import settings
+
+CrawlPlan = namedtuple('CrawlPlan', ['keywords', 'request_count', 'seconds'])
+CrawlPlan.__doc__ = """爬取计划
+
+Attributes:
+    keywords (list): 需要爬取的关键词，顺序与输入相同。
+    request_count (int): 估算的请求数，分页请求无法预知，按每个关键词一个请求计算。
+    seconds (float): 按配置的速率估算的耗时。
+"""
+
+def plan_keywords(database, keywords, forceupdate=False):
+    """keyword 爬取计划"""
+    if not forceupdate:
+        need_upsert = database.get_keywords_need_upsert(keywords)
+        keywords = [x for x in keywords if x in need_upsert]
+    return _create_plan(keywords, settings.RATE_HZ_MYDATA)
+
+def plan_ranks(database, keywords, forceupdate=False):
+    """rank 爬取计划"""
+    if not forceupdate:
+        need_upsert = database.get_ranks_need_upsert(keywords)
+        keywords = [x for x in keywords if x in need_upsert]
+    return _create_plan(keywords, settings.RATE_HZ_MYDATA)
+
+def plan_stale_keywords(database, keywords, limit):
+    """最久未更新的 limit 个关键词的 keyword 爬取计划，没有记录的关键词在最前"""
+    plan = plan_keywords(database, keywords)
+    keywords = _get_stalest(plan.keywords, database.get_keyword_updates(), limit)
+    return _create_plan(keywords, settings.RATE_HZ_MYDATA)
+
+def plan_stale_ranks(database, keywords, limit):
+    """最久未更新的 limit 个关键词的 rank 爬取计划，没有记录的关键词在最前"""
+    plan = plan_ranks(database, keywords)
+    keywords = _get_stalest(plan.keywords, database.get_rank_updates(), limit)
+    return _create_plan(keywords, settings.RATE_HZ_MYDATA)
+
+def _get_stalest(keywords, updates, limit):
+    def staleness(keyword):
+        update = updates.get(normalize_keyword(keyword))
+        return (0,) if update is None else (1, update)
+    return sorted(keywords, key=staleness)[:limit]
+
+def _create_plan(keywords, rate):
+    request_count = len(keywords)
+    return CrawlPlan(keywords=keywords, request_count=request_count, seconds=request_count / rate)
+
+def format_plan(name, total, plan):
+    """格式化爬取计划，用于输出"""
+    minutes, seconds = divmod(int(plan.seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '[%s] %d/%d need craw, about %d requests, %d:%02d:%02d' % (
+        name, len(plan.keywords), total, plan.request_count, hours, minutes, seconds
+    )
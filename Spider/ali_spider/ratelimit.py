@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+"""ratelimit
+
+请求限速模块，每个 host 使用独立的令牌桶，速率根据服务器响应自动调整。
+"""
+
+import threading
+import time
+from urllib.parse import urlsplit
+import settings
+
+class TokenBucket():
+    """自适应令牌桶。
+
+    响应正常时速率线性增加，服务器限流时速率减半 (AIMD)。
+
+    Args:
+        rate (float): 初始速率，每秒请求数。
+        burst (int): 桶容量，即允许的突发请求数。
+        min_rate (float): 最小速率。
+        max_rate (float): 最大速率。
+    """
+
+    def __init__(self, rate, burst=1, min_rate=None, max_rate=None):
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min(min_rate or rate, rate)
+        self.max_rate = max(max_rate or rate, rate)
+        self.tokens = burst
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """获取一个令牌，没有可用令牌时等待。
+
+        Returns:
+            float: 等待的秒数。
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def on_success(self):
+        """响应正常，增加速率。"""
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.base_rate / 10)
+
+    def on_throttle(self):
+        """服务器限流，速率减半并清空突发额度。"""
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+class RateLimiter():
+    """按 host 管理令牌桶，速率配置见 settings 中的 RATE_* 项。"""
+
+    def __init__(self):
+        self.host_rates = {
+            'hz-mydata.alibaba.com': settings.RATE_HZ_MYDATA,
+            'hz-productposting.alibaba.com': settings.RATE_HZ_PRODUCTPOSTING,
+            'www2.alibaba.com': settings.RATE_WWW2,
+        }
+        self.buckets = dict()
+        self.lock = threading.Lock()
+
+    def get_bucket(self, url):
+        """获取 url 所属 host 的令牌桶"""
+        host = urlsplit(url).hostname
+        with self.lock:
+            bucket = self.buckets.get(host)
+            if bucket is None:
+                bucket = TokenBucket(
+                    rate=self.host_rates.get(host, settings.RATE_DEFAULT),
+                    burst=settings.RATE_BURST,
+                    min_rate=settings.RATE_MIN,
+                    max_rate=settings.RATE_MAX,
+                )
+                self.buckets[host] = bucket
+            return bucket
+
+    def acquire(self, url):
+        """请求 url 前调用，等待到 host 的下一个可用时间点"""
+        return self.get_bucket(url).acquire()
+
+    def feedback(self, url, throttled):
+        """根据响应结果调整 host 的速率
+
+        Args:
+            url (str): 请求的 url。
+            throttled (bool): 服务器是否在限流。
+        """
+        bucket = self.get_bucket(url)
+        if throttled:
+            bucket.on_throttle()
+        else:
+            bucket.on_success()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+"""report
+
+报表数据模块。
+
+一次性批量加载关键词、排名、产品和关键词到产品的映射，并建立内存索引，
+之后按关键词顺序一次遍历生成报表行。
+"""
+
+from normalizer import normalize_keyword
+
+class OverviewReport():
+    """overview 报表数据
+
+    Args:
+        database (Database): 数据库对象。
+    """
+
+    def __init__(self, database):
+        self.keywords_info = database.get_keywords_info()
+        self.rank_info = database.get_all_rank_info()
+        self.product_ids_map = database.get_keyword_product_ids_map()
+        self.products = {x.id: x for x in database.get_all_products()}
+
+    def rows(self, keywords, generate_date):
+        """生成 overview 报表行，列与 CSV_Generator.generate_overview_csv 的表头相同
+
+        Args:
+            keywords (list): 关键词列表。
+            generate_date (date): 数据更新时间。
+        """
+        for keyword in keywords:
+            t_keyword = keyword.strip()
+            keyword_norm = normalize_keyword(t_keyword)
+
+            t_is_p4p_keyword = None
+            t_company_cnt = t_showwin_cnt = t_srh_pv = "-"
+            keyword_info = self.keywords_info.get(keyword_norm)
+            if keyword_info is not None:
+                is_p4p_keyword, company_cnt, showwin_cnt, srh_pv_this_mon = keyword_info
+                if is_p4p_keyword is not None:
+                    t_is_p4p_keyword = is_p4p_keyword
+                if company_cnt is not None:
+                    t_company_cnt = company_cnt
+                if showwin_cnt is not None:
+                    t_showwin_cnt = showwin_cnt
+                if srh_pv_this_mon is not None:
+                    t_srh_pv = srh_pv_this_mon
+
+            rank_info = self.rank_info.get(keyword_norm)
+            rank_dict = dict()
+            t_top1_ranking = t_top1_style_no = t_top1_modify_time = "-"
+            if rank_info is not None:
+                rank_dict = {x["product_id"]: x["ranking"] for x in rank_info}
+                top1_rank = min(rank_info, key=lambda x: x['ranking'])
+                top1_product = self.products.get(top1_rank['product_id'])
+
+                t_top1_ranking = top1_rank['ranking']
+                t_top1_style_no = top1_product.style_no
+                t_top1_modify_time = top1_product.modify_time
+
+            product_ids = self.product_ids_map.get(keyword_norm, [])
+            if len(product_ids) == 0:
+                yield [
+                    t_keyword, None, None, None, None, t_top1_ranking,
+                    t_top1_style_no, t_top1_modify_time, None,
+                    None, t_is_p4p_keyword, t_company_cnt,
+                    t_showwin_cnt, t_srh_pv, generate_date
+                ]
+                continue
+
+            for product_id in product_ids:
+                product = self.products[product_id]
+                yield [
+                    t_keyword, product.owner, product.style_no, rank_dict.get(product.id),
+                    product.modify_time, t_top1_ranking,
+                    t_top1_style_no, t_top1_modify_time, product.is_trade_product,
+                    product.is_window_product, t_is_p4p_keyword, t_company_cnt,
+                    t_showwin_cnt, t_srh_pv, generate_date
+                ]
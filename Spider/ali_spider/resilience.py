@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+"""resilience
+
+请求失败处理模块：指数退避和按 host 的熔断器。
+
+熔断器在一个 host 连续失败 CIRCUIT_FAILURES 次后打开，打开期间该 host 的请求等待而不是发送，
+CIRCUIT_OPEN_SECONDS 秒后只放行一个试探请求，成功则关闭，失败则再次打开并加倍等待时间。
+持续打开超过 CIRCUIT_GIVE_UP_SECONDS 秒时抛出 CircuitOpenError，本次爬取结束，未完成的请求
+保留在 frontier 中，下次运行继续。
+"""
+
+import time
+import random
+import threading
+from urllib.parse import urlsplit
+import settings
+
+class CircuitOpenError(Exception):
+    """host 的熔断器打开时间过长"""
+
+def backoff_delay(attempt, base=None, cap=None):
+    """第 attempt 次重试前的等待秒数，指数增长并加入随机抖动
+
+    Args:
+        attempt (int): 重试次数，从 0 开始。
+        base (float): 第一次重试的最大等待秒数，默认为 HTTP_BACKOFF_BASE。
+        cap (float): 最大等待秒数，默认为 HTTP_BACKOFF_MAX。
+    """
+    base = settings.HTTP_BACKOFF_BASE if base is None else base
+    cap = settings.HTTP_BACKOFF_MAX if cap is None else cap
+    delay = min(cap, base * 2 ** attempt)
+    # 抖动使同时失败的请求不会同时重试
+    return random.uniform(delay / 2, delay)
+
+class CircuitBreaker():
+    """熔断器
+
+    Args:
+        failures (int): 打开前的连续失败次数。
+        open_seconds (float): 第一次打开的秒数，之后每次试探失败加倍，最多 8 倍。
+        give_up_seconds (float): 持续打开超过该秒数时 acquire 抛出 CircuitOpenError。
+    """
+
+    def __init__(self, failures, open_seconds, give_up_seconds):
+        self.failures = max(failures, 1)
+        self.open_seconds = open_seconds
+        self.give_up_seconds = give_up_seconds
+        self.condition = threading.Condition()
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.open_until = 0
+        self.opens = 0
+        self.probing = False
+
+    def acquire(self):
+        """发送请求前调用，熔断器打开时等待，半开时只放行一个请求
+
+        Returns:
+            float: 等待的秒数。
+        """
+        start = time.monotonic()
+        with self.condition:
+            while self.opened_at is not None:
+                now = time.monotonic()
+                if now - self.opened_at > self.give_up_seconds:
+                    raise CircuitOpenError('circuit open for %ds' % (now - self.opened_at))
+                if now >= self.open_until and not self.probing:
+                    self.probing = True
+                    break
+                self.condition.wait(max(self.open_until - now, 0.1) if not self.probing else 1)
+        return time.monotonic() - start
+
+    def on_success(self):
+        with self.condition:
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self.opens = 0
+            self.probing = False
+            self.condition.notify_all()
+
+    def on_failure(self):
+        """记录一次失败，返回熔断器是否因此打开"""
+        with self.condition:
+            self.consecutive_failures += 1
+            if self.opened_at is not None and not self.probing:
+                # 打开前已发送的请求
+                return False
+            if self.opened_at is None and self.consecutive_failures < self.failures:
+                return False
+            now = time.monotonic()
+            if self.opened_at is None:
+                self.opened_at = now
+            self.open_until = now + self.open_seconds * 2 ** min(self.opens, 3)
+            self.opens += 1
+            self.probing = False
+            self.condition.notify_all()
+            return True
+
+class CircuitBreakers():
+    """按 host 管理熔断器，配置见 settings 中的 CIRCUIT_* 项。"""
+
+    def __init__(self):
+        self.breakers = dict()
+        self.lock = threading.Lock()
+
+    def get_breaker(self, url):
+        """获取 url 所属 host 的熔断器"""
+        host = urlsplit(url).hostname
+        with self.lock:
+            breaker = self.breakers.get(host)
+            if breaker is None:
+                breaker = CircuitBreaker(
+                    failures=settings.CIRCUIT_FAILURES,
+                    open_seconds=settings.CIRCUIT_OPEN_SECONDS,
+                    give_up_seconds=settings.CIRCUIT_GIVE_UP_SECONDS,
+                )
+                self.breakers[host] = breaker
+            return breaker
+
+    def acquire(self, url):
+        return self.get_breaker(url).acquire()
+
+    def feedback(self, url, failed):
+        """根据请求结果更新 host 的熔断器，返回熔断器是否因此打开"""
+        breaker = self.get_breaker(url)
+        if failed:
+            return breaker.on_failure()
+        breaker.on_success()
+        return False
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+"""sessionstate
+
+登录状态缓存，保存 cookies、csrf token、ctoken、dmtrack_pageid 及其获取时间。
+
+状态保存在 SESSION_STATE_FILE 中，下次运行时直接使用，不需要再打开预热页面和 token 页面。
+只有请求的响应表明状态已失效时才调用 invalidate，之后重新验证登录并获取 token。
+"""
+
+import os
+import time
+import pickle
+
+# 登录后才有的 cookie，其中包含 ctoken
+LOGIN_COOKIE = 'xman_us_t'
+
+class SessionState():
+    """登录状态
+
+    Attributes:
+        cookies (RequestsCookieJar): 登录 cookies，未登录时为 None。
+        tokens (dict): token 名称 -> (token, 获取时间)。
+        validated (float): 最近一次确认登录有效的时间，0 表示需要重新确认。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.cookies = None
+        self.tokens = dict()
+        self.validated = 0
+
+    @classmethod
+    def load(cls, path, cookies_file=None):
+        """读取状态文件，不存在时从旧版本的 cookies 文件 cookies_file 读取 cookies"""
+        state = cls(path)
+        if os.path.exists(path):
+            with open(path, 'rb') as state_file:
+                data = pickle.load(state_file)
+            state.cookies = data.get('cookies')
+            state.tokens = data.get('tokens', dict())
+            state.validated = data.get('validated', 0)
+        elif cookies_file is not None and os.path.exists(cookies_file):
+            with open(cookies_file, 'rb') as dump:
+                state.cookies = pickle.load(dump)
+        return state
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(temp_path, 'wb') as state_file:
+            pickle.dump({
+                'cookies': self.cookies,
+                'tokens': self.tokens,
+                'validated': self.validated,
+            }, state_file)
+        os.replace(temp_path, self.path)
+
+    def is_valid(self):
+        """登录已确认有效，并且登录 cookie 存在且没有过期"""
+        if not self.validated or self.cookies is None:
+            return False
+        now = time.time()
+        return any(x.name == LOGIN_COOKIE and not x.is_expired(now) for x in self.cookies)
+
+    def mark_validated(self):
+        self.validated = time.time()
+
+    def invalidate(self):
+        """状态已失效，需要重新确认登录并获取 token"""
+        self.validated = 0
+        self.tokens.clear()
+
+    def has_token(self, name, max_age=0):
+        """token 已缓存并且没有超过 max_age 秒，max_age 为 0 时不限时间
+
+        缓存的 token 可以是 None，例如页面中没有 dmtrack_pageid，这时也不需要重新获取。
+        """
+        if name not in self.tokens:
+            return False
+        return not max_age or time.time() - self.tokens[name][1] <= max_age
+
+    def get_token(self, name, max_age=0):
+        """返回 token，不存在或超过 max_age 秒时返回 None，max_age 为 0 时不限时间"""
+        if not self.has_token(name, max_age):
+            return None
+        return self.tokens[name][0]
+
+    def set_token(self, name, token):
+        self.tokens[name] = (token, time.time())
@@ -4,12 +4,27 @@ import configparser
 import os
 import sys
 
+# Default values, load() replaces them with config.ini, importing this module has no side effect
+
 # File path
 BASE_KEYWORDS_FILE = './config/base_keywords.txt'
 NEGATIVE_KEYWORDS_FILE = './config/negative_keywords.txt'
 
 # Database setting
 DATABASE_URL = 'sqlite:///./database/data.db'
+DATABASE_BATCH_SIZE = 500
+DATABASE_COMMIT_INTERVAL = 5000
+
+# SQLite storage profile, applied to every connection, empty string or 0 keeps the SQLite default
+DATABASE_JOURNAL_MODE = 'wal'
+DATABASE_SYNCHRONOUS = 'normal'
+DATABASE_CACHE_SIZE = -65536
+DATABASE_MMAP_SIZE = 268435456
+
+# Rank history, keep daily rows for RANK_HISTORY_DAILY_DAYS days then weekly rows,
+# rows older than RANK_HISTORY_RETENTION_DAYS days are deleted, 0 keeps them forever
+RANK_HISTORY_DAILY_DAYS = 90
+RANK_HISTORY_RETENTION_DAYS = 0
 
 # Debug
 DATABASE_ECHO = False
@@ -20,28 +35,130 @@ LOGIN_ID = ''
 LOGIN_PASSWORD = ''
 LOGIN_TIMEOUT = 30
 FIREFOX_PATH = '/usr/bin/firefox'
+# Cookies and tokens kept between runs, the session is renewed at most SESSION_RENEW_LIMIT times
+# for a request whose response shows the login or a token is invalid
+SESSION_STATE_FILE = './config/session.pkl'
+SESSION_RENEW_LIMIT = 2
 
 # Generate
 REG_CATEGORIES = ''
 
 # Craw
-CRAW_SLEEP_MIN = 1
-CRAW_SLEEP_MAX = 3
+CRAW_CONCURRENCY = 1
+# A leased frontier request is available again after FRONTIER_LEASE_SECONDS, the leases still in
+# process are renewed each time more requests are leased
+FRONTIER_LEASE_SECONDS = 300
+# A frontier request that fails or can't be parsed this many times is moved to the dead letters
+FRONTIER_MAX_ATTEMPTS = 5
+# The incremental products sync also checks all product ids for removed products at least every
+# PRODUCTS_ID_PASS_DAYS days, an added and a removed product leave the products count unchanged
+PRODUCTS_ID_PASS_DAYS = 7
+# Fetch, parse and write pipeline, max items in each queue and max results of each write
+PIPELINE_QUEUE_SIZE = 20
+PIPELINE_BATCH_SIZE = 50
+# Seconds a cached token is reused before it is fetched again, 0 reuses it until a response
+# shows it is invalid; the tokens of a host are also fetched again after TOKEN_THROTTLE_LIMIT
+# consecutive throttled responses, a stale token may be rejected like a throttled request
+TOKEN_MAX_AGE = 86400
+TOKEN_THROTTLE_LIMIT = 5
+# Proxy of all crawler requests, such as the local simulator in benchmarks/alisim.py
+HTTP_PROXY = ''
+
+# Daemon, keywords and ranks are crawled in batches of the stalest DAEMON_BATCH_SIZE keywords,
+# a keyword still stale after a craw is retried after DAEMON_RETRY_SECONDS, category and p4p are
+# crawled every DAEMON_CATEGORY_SECONDS and DAEMON_P4P_SECONDS, a failed job is skipped for
+# DAEMON_FAILED_RETRY_SECONDS so the other jobs still run
+DAEMON_BATCH_SIZE = 200
+DAEMON_IDLE_SECONDS = 300
+DAEMON_RETRY_SECONDS = 86400
+DAEMON_CATEGORY_SECONDS = 86400
+DAEMON_P4P_SECONDS = 86400
+DAEMON_FAILED_RETRY_SECONDS = 3600
+
+# Resilience, connect and read timeouts of each request in seconds, connection errors, timeouts
+# and HTTP 429/5xx are retried HTTP_RETRIES times with an exponential backoff from
+# HTTP_BACKOFF_BASE up to HTTP_BACKOFF_MAX seconds; the requests of a host pause for
+# CIRCUIT_OPEN_SECONDS after CIRCUIT_FAILURES consecutive failures, and the craw stops when the
+# host still fails after CIRCUIT_GIVE_UP_SECONDS
+HTTP_CONNECT_TIMEOUT = 10
+HTTP_READ_TIMEOUT = 60
+HTTP_RETRIES = 3
+HTTP_BACKOFF_BASE = 1
+HTTP_BACKOFF_MAX = 60
+CIRCUIT_FAILURES = 5
+CIRCUIT_OPEN_SECONDS = 30
+CIRCUIT_GIVE_UP_SECONDS = 1800
+
+# Rate limit, requests per second of each host
+RATE_HZ_MYDATA = 0.5
+RATE_HZ_PRODUCTPOSTING = 0.5
+RATE_WWW2 = 0.5
+RATE_DEFAULT = 0.5
+RATE_MIN = 0.1
+RATE_MAX = 2
+RATE_BURST = 1
+
+# Metrics, a JSON summary is written at the end of each craw, the Prometheus textfile is
+# rewritten every METRICS_INTERVAL seconds during the craw, empty path disables the export
+METRICS_JSON_FILE = './log/metrics.json'
+METRICS_TEXTFILE = ''
+METRICS_INTERVAL = 60
 
 _CONFIG_FILE = './config/config.ini'
 _CONFIG_DICT = {
     'BASE_KEYWORDS_FILE': ['Files', 'base_keywords_file'],
     'NEGATIVE_KEYWORDS_FILE': ['Files', 'negative_keywords_file'],
     'DATABASE_URL': ['Database', 'database_url'],
+    'DATABASE_BATCH_SIZE': ['Database', 'batch_size'],
+    'DATABASE_COMMIT_INTERVAL': ['Database', 'commit_interval'],
+    'DATABASE_JOURNAL_MODE': ['Database', 'journal_mode'],
+    'DATABASE_SYNCHRONOUS': ['Database', 'synchronous'],
+    'DATABASE_CACHE_SIZE': ['Database', 'cache_size'],
+    'DATABASE_MMAP_SIZE': ['Database', 'mmap_size'],
+    'RANK_HISTORY_DAILY_DAYS': ['RankHistory', 'daily_days'],
+    'RANK_HISTORY_RETENTION_DAYS': ['RankHistory', 'retention_days'],
     'DATABASE_ECHO': ['Debug', 'database_echo'],
     'HTTP_DEBUGLEVEL': ['Debug', 'http_debuglevel'],
     'LOGIN_ID': ['Login', 'login_id'],
     'LOGIN_PASSWORD': ['Login', 'login_password'],
     'LOGIN_TIMEOUT': ['Login', 'login_timeout'],
     'FIREFOX_PATH': ['Login', 'firefox_path'],
+    'SESSION_STATE_FILE': ['Login', 'session_state_file'],
+    'SESSION_RENEW_LIMIT': ['Login', 'session_renew_limit'],
     'REG_CATEGORIES': ['Generate', 'reg_categories'],
-    'CRAW_SLEEP_MIN': ['Craw', 'craw_sleep_min'],
-    'CRAW_SLEEP_MAX': ['Craw', 'craw_sleep_max'],
+    'CRAW_CONCURRENCY': ['Craw', 'craw_concurrency'],
+    'FRONTIER_LEASE_SECONDS': ['Craw', 'frontier_lease_seconds'],
+    'FRONTIER_MAX_ATTEMPTS': ['Craw', 'frontier_max_attempts'],
+    'PRODUCTS_ID_PASS_DAYS': ['Craw', 'products_id_pass_days'],
+    'PIPELINE_QUEUE_SIZE': ['Craw', 'pipeline_queue_size'],
+    'PIPELINE_BATCH_SIZE': ['Craw', 'pipeline_batch_size'],
+    'TOKEN_MAX_AGE': ['Craw', 'token_max_age'],
+    'TOKEN_THROTTLE_LIMIT': ['Craw', 'token_throttle_limit'],
+    'HTTP_PROXY': ['Craw', 'http_proxy'],
+    'DAEMON_BATCH_SIZE': ['Daemon', 'batch_size'],
+    'DAEMON_IDLE_SECONDS': ['Daemon', 'idle_seconds'],
+    'DAEMON_RETRY_SECONDS': ['Daemon', 'retry_seconds'],
+    'DAEMON_CATEGORY_SECONDS': ['Daemon', 'category_seconds'],
+    'DAEMON_P4P_SECONDS': ['Daemon', 'p4p_seconds'],
+    'DAEMON_FAILED_RETRY_SECONDS': ['Daemon', 'failed_retry_seconds'],
+    'HTTP_CONNECT_TIMEOUT': ['Resilience', 'http_connect_timeout'],
+    'HTTP_READ_TIMEOUT': ['Resilience', 'http_read_timeout'],
+    'HTTP_RETRIES': ['Resilience', 'http_retries'],
+    'HTTP_BACKOFF_BASE': ['Resilience', 'http_backoff_base'],
+    'HTTP_BACKOFF_MAX': ['Resilience', 'http_backoff_max'],
+    'CIRCUIT_FAILURES': ['Resilience', 'circuit_failures'],
+    'CIRCUIT_OPEN_SECONDS': ['Resilience', 'circuit_open_seconds'],
+    'CIRCUIT_GIVE_UP_SECONDS': ['Resilience', 'circuit_give_up_seconds'],
+    'RATE_HZ_MYDATA': ['RateLimit', 'hz_mydata'],
+    'RATE_HZ_PRODUCTPOSTING': ['RateLimit', 'hz_productposting'],
+    'RATE_WWW2': ['RateLimit', 'www2'],
+    'RATE_DEFAULT': ['RateLimit', 'default'],
+    'RATE_MIN': ['RateLimit', 'min_rate'],
+    'RATE_MAX': ['RateLimit', 'max_rate'],
+    'RATE_BURST': ['RateLimit', 'burst'],
+    'METRICS_JSON_FILE': ['Metrics', 'json_file'],
+    'METRICS_TEXTFILE': ['Metrics', 'textfile'],
+    'METRICS_INTERVAL': ['Metrics', 'interval'],
 }
 
 def read_config():
@@ -52,9 +169,22 @@ def read_config():
         try:
             if key == 'DATABASE_ECHO':
                 setattr(module, key, config.getboolean(value[0], value[1]))
-            elif key in ['HTTP_DEBUGLEVEL', 'LOGIN_TIMEOUT']:
+            elif key in ['HTTP_DEBUGLEVEL', 'LOGIN_TIMEOUT', 'CRAW_CONCURRENCY', 'RATE_BURST',
+                         'FRONTIER_LEASE_SECONDS', 'PIPELINE_QUEUE_SIZE', 'PIPELINE_BATCH_SIZE',
+                         'DATABASE_BATCH_SIZE',
+                         'DATABASE_COMMIT_INTERVAL', 'DATABASE_CACHE_SIZE', 'DATABASE_MMAP_SIZE',
+                         'RANK_HISTORY_DAILY_DAYS', 'RANK_HISTORY_RETENTION_DAYS',
+                         'METRICS_INTERVAL', 'TOKEN_MAX_AGE', 'TOKEN_THROTTLE_LIMIT',
+                         'DAEMON_BATCH_SIZE',
+                         'DAEMON_IDLE_SECONDS', 'DAEMON_RETRY_SECONDS', 'DAEMON_CATEGORY_SECONDS',
+                         'DAEMON_P4P_SECONDS', 'DAEMON_FAILED_RETRY_SECONDS',
+                         'SESSION_RENEW_LIMIT', 'FRONTIER_MAX_ATTEMPTS', 'PRODUCTS_ID_PASS_DAYS',
+                         'HTTP_RETRIES', 'CIRCUIT_FAILURES']:
                 setattr(module, key, config.getint(value[0], value[1]))
-            elif key in ['CRAW_SLEEP_MIN', 'CRAW_SLEEP_MAX']:
+            elif key in ['RATE_HZ_MYDATA', 'RATE_HZ_PRODUCTPOSTING', 'RATE_WWW2', 'RATE_DEFAULT',
+                         'RATE_MIN', 'RATE_MAX', 'HTTP_CONNECT_TIMEOUT', 'HTTP_READ_TIMEOUT',
+                         'HTTP_BACKOFF_BASE', 'HTTP_BACKOFF_MAX', 'CIRCUIT_OPEN_SECONDS',
+                         'CIRCUIT_GIVE_UP_SECONDS']:
                 setattr(module, key, config.getfloat(value[0], value[1]))
             else:
                 setattr(module, key, config.get(value[0], value[1]))
@@ -76,7 +206,9 @@ def write_default_config():
                 config.set(section, option, option_value)
         config.write(cfgfile)
 
-if os.path.isfile(_CONFIG_FILE):
-    read_config()
-else:
-    write_default_config()
+def load():
+    """read config.ini, write the default config.ini if it does not exist"""
+    if os.path.isfile(_CONFIG_FILE):
+        read_config()
+    else:
+        write_default_config()
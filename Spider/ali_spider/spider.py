@@ -1,51 +1,92 @@
 #! /usr/bin/env python
 
 """Spider Main
+
+Each command imports the modules it uses, so commands such as generate do not load
+requests and selenium.
 """
 
 import argparse
 import json
-from crawler import Crawler
-from database import Database
-from generator import CSV_Generator
-
-database = Database()
+from datetime import datetime
+import settings
 
-def craw(args=None):
+def craw(database, args=None):
     """craw command bind function
     """
+    from crawler import Crawler
+    from metrics import TextfileExporter
     
-    try:
-        crawler = Crawler(database=database)
-        func = {
-            "products": crawler.craw_products,
-            "keywords": crawler.craw_keywords,
-            "rank": crawler.craw_rank,
-            "p4p": crawler.craw_p4p,
-        }
+    if args is not None:
+        actions = [args.action]
+        forceupdate = args.forceupdate
+    else:
+        actions = ['products', 'keywords', 'rank']
+        forceupdate = False
 
-        if args is not None:
-            actions = [args.action]
-            forceupdate = args.forceupdate
-        else:
-            actions = ['products', 'keywords', 'rank']
-            forceupdate = False
+    started = datetime.now()
+    try:
+        with TextfileExporter(settings.METRICS_TEXTFILE, settings.METRICS_INTERVAL):
+            concurrency = args.concurrency if args is not None else None
+            crawler = Crawler(database=database, concurrency=concurrency)
+            func = {
+                "products": crawler.craw_products,
+                "keywords": crawler.craw_keywords,
+                "rank": crawler.craw_rank,
+                "p4p": crawler.craw_p4p,
+            }
 
-        for action in actions:
-            func.get(action)(forceupdate=forceupdate)
+            # 一个任务失败时继续执行其他任务，未完成的请求保留在 frontier 中
+            for action in actions:
+                try:
+                    func.get(action)(forceupdate=forceupdate)
+                except Exception as e:
+                    print("[%s] failed: %s" % (action, e))
+            crawler.save_session_state()
             
     except Exception as e:
         print(e);
+    finally:
+        _write_metrics(actions, started)
+
+def daemon(database, args):
+    """daemon bind function, craw by staleness until SIGTERM or Ctrl-C
+    """
+    from crawler import Crawler
+    from daemon import Daemon
+    from metrics import TextfileExporter
+
+    started = datetime.now()
+    try:
+        with TextfileExporter(settings.METRICS_TEXTFILE, settings.METRICS_INTERVAL):
+            crawler = Crawler(database=database, concurrency=args.concurrency)
+            Daemon(crawler, database).run()
+    except KeyboardInterrupt:
+        print('[Daemon] interrupted')
+    finally:
+        _write_metrics(['daemon'], started)
+
+def _write_metrics(actions, started):
+    from metrics import REGISTRY
+
+    if settings.METRICS_JSON_FILE:
+        REGISTRY.write_json(
+            settings.METRICS_JSON_FILE, actions=actions, started_at=started.isoformat(),
+            finished_at=datetime.now().isoformat(),
+        )
 
-def generate(args=None):
+def generate(database, args=None):
     """generate bind function
     """
+    from generator import CSV_Generator
+
     try:
         csv_generator = CSV_Generator(database=database)
         func = {
             'overview': csv_generator.generate_overview_csv,
             'keywords': csv_generator.generate_keywords_csv,
             'p4p': csv_generator.generate_p4p_csv,
+            'trends': csv_generator.generate_trends_csv,
         }
         if args is not None:
             actions = [args.action]
@@ -54,12 +95,44 @@ def generate(args=None):
             
         for action in actions:
             func.get(action)()
+            print('[Cache] products %s' % ', '.join(
+                '%s: %s' % x for x in database.product_cache.stats().items()))
 
     except AttributeError:
         print("product data is expired, please craw it again.")
     except Exception as e:
         print(e);
 
+def history(database, args):
+    """history bind function, print the rank trajectory of a keyword or a product
+    """
+    start = datetime.strptime(args.start, '%Y-%m-%d').date() if args.start else None
+    end = datetime.strptime(args.end, '%Y-%m-%d').date() if args.end else None
+    if args.target == 'keyword':
+        rows = database.get_keyword_rank_history(args.value, start=start, end=end)
+    else:
+        rows = database.get_product_rank_history(int(args.value), start=start, end=end)
+    for day, item, ranking in rows:
+        print("%s\t%s\t%.2f" % (day.isoformat(), item, ranking))
+
+def deadletter(database, args):
+    """deadletter bind function, list the failed frontier requests or requeue them
+    """
+    if args.action == 'list':
+        for letter in database.get_dead_letters(args.kind):
+            print("%s\t%s\t%d\t%s\t%s" % (
+                letter.created.isoformat(sep=' ', timespec='seconds'), letter.kind,
+                letter.attempts, json.dumps(letter.task, ensure_ascii=False), letter.error))
+    else:
+        count = database.requeue_dead_letters(args.kind)
+        print("[DeadLetter] %d requests requeued, the next craw continues with them" % count)
+
+def migrate(database, args=None):
+    """migrate bind function
+    """
+    for step, count in sorted(database.migrate().items()):
+        print("[Migrate] %s: %d rows converted" % (step, count))
+
 def main():
     """main function
     """
@@ -67,6 +140,16 @@ def main():
     subparsers = parser.add_subparsers()
     craw_parser = subparsers.add_parser('craw', help="craw data and save to database")
     generate_parser = subparsers.add_parser('generate', help="generate csv file")
+    daemon_parser = subparsers.add_parser(
+        'daemon', help="craw continuously by data staleness with one warm session"
+    )
+    history_parser = subparsers.add_parser('history', help="print rank history")
+    deadletter_parser = subparsers.add_parser(
+        'deadletter', help="list or requeue requests that failed too many times"
+    )
+    migrate_parser = subparsers.add_parser(
+        'migrate', help="convert an existing database to the current storage format"
+    )
     craw_parser.add_argument(
         'action', choices=['products', 'keywords', 'rank', 'p4p'],
         help='craw specific type items'
@@ -74,18 +157,47 @@ def main():
     craw_parser.add_argument(
         '-f', dest="forceupdate", action="store_true", help='force update'
     )
+    craw_parser.add_argument(
+        '-c', '--concurrency', dest="concurrency", type=int,
+        help='number of requests in flight, default from config'
+    )
+    daemon_parser.add_argument(
+        '-c', '--concurrency', dest="concurrency", type=int,
+        help='number of requests in flight, default from config'
+    )
     generate_parser.add_argument(
-        'action', choices=['overview', 'keywords', 'p4p'],
+        'action', choices=['overview', 'keywords', 'p4p', 'trends'],
         help='generate specific csv file'
     )
+    history_parser.add_argument(
+        'target', choices=['keyword', 'product'], help='query by keyword or product id'
+    )
+    history_parser.add_argument('value', help='keyword or product id')
+    history_parser.add_argument('--start', dest="start", help='first date, YYYY-MM-DD')
+    history_parser.add_argument('--end', dest="end", help='last date, YYYY-MM-DD')
+    deadletter_parser.add_argument(
+        'action', choices=['list', 'requeue'], help='list or requeue dead letters'
+    )
+    deadletter_parser.add_argument(
+        '--kind', dest="kind", choices=['keyword', 'category', 'rank', 'p4p'],
+        help='only the dead letters of the request kind'
+    )
     craw_parser.set_defaults(func=craw)
+    daemon_parser.set_defaults(func=daemon)
+    history_parser.set_defaults(func=history)
+    deadletter_parser.set_defaults(func=deadletter)
     generate_parser.set_defaults(func=generate)
+    migrate_parser.set_defaults(func=migrate)
     args = parser.parse_args()
+    settings.load()
+    from database import Database
+    database = Database()
     try:
-        args.func(args)
-    except AttributeError:
-        craw()
-        generate()
+        if hasattr(args, 'func'):
+            args.func(database, args)
+        else:
+            craw(database)
+            generate(database)
     finally:
         database.close()
 
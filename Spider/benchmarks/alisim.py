@@ -0,0 +1,281 @@
+#! /usr/bin/env python
+
+"""Local stand-in for the Alibaba seller endpoints used by the crawler.
+
+The server answers the product list, keyword search, keyword rank, category and p4p requests
+and the pages the crawler reads its csrf tokens and dmtrack page id from, with synthetic data.
+The crawler reaches it as an HTTP proxy, set `http_proxy` in the Craw section of config.ini
+(settings.HTTP_PROXY) to http://127.0.0.1:<port>.
+
+Usage:
+    python benchmarks/alisim.py [--port 8765] [--products 500] [--latency 0.05] ...
+"""
+
+import json
+import time
+import random
+import argparse
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+TOKEN = 'simcsrftoken'
+SRH_PV_KEYS = ['srh_pv_this_mon'] + ['srh_pv_last_%dmon' % i for i in range(1, 12)]
+
+class Simulator():
+    """Synthetic data and behavior of the simulated server.
+
+    Args:
+        products (int): count of products, each has 3 keywords.
+        keyword_results (int): total results of each keyword search, 10 per page.
+        rank_results (int): products in each rank result.
+        p4p_pages (int): pages of p4p keywords, 20 keywords per page.
+        latency (float): seconds added to each response.
+        max_rps (float): requests per second of each host before answering 429, 0 for no limit.
+        throttle_ratio (float): ratio of requests answered with successed false.
+        token_requests (int): the csrf token and ctoken change after this many requests, a
+            request with an old token is answered with 403, 0 keeps the token.
+        error_ratio (float): ratio of API requests answered with 503.
+    """
+
+    def __init__(self, products=500, keyword_results=25, rank_results=5, p4p_pages=5,
+                 latency=0.05, max_rps=0, throttle_ratio=0, token_requests=0,
+                 error_ratio=0):
+        self.products = products
+        self.keyword_results = keyword_results
+        self.rank_results = rank_results
+        self.p4p_pages = p4p_pages
+        self.latency = latency
+        self.max_rps = max_rps
+        self.throttle_ratio = throttle_ratio
+        self.token_requests = token_requests
+        self.error_ratio = error_ratio
+        self.token = TOKEN
+        self.token_checks = 0
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+        self.page_loads = 0
+        self.rejected = 0
+        self.errors = 0
+        self.windows = dict()
+        self.random = random.Random(0)
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests = 0
+            self.throttled = 0
+            self.page_loads = 0
+            self.rejected = 0
+            self.errors = 0
+
+    def _check_token(self, query, form):
+        """rotate the token every token_requests requests, return False for an old token."""
+        with self.lock:
+            self.token_checks += 1
+            if self.token_requests and self.token_checks % self.token_requests == 0:
+                self.token = '%s%d' % (TOKEN, self.token_checks)
+            tokens = [x.get(y) for x in [query, form] for y in ['_csrf_token_', 'ctoken']]
+            if any(x is not None and x != self.token for x in tokens):
+                self.rejected += 1
+                return False
+            return True
+
+    def _is_over_rate(self, host):
+        if not self.max_rps:
+            return False
+        now = time.monotonic()
+        with self.lock:
+            window = [x for x in self.windows.get(host, []) if now - x < 1]
+            window.append(now)
+            self.windows[host] = window
+            return len(window) > self.max_rps
+
+    def handle(self, method, host, path, query, form):
+        """return (status, content type, body, extra headers) of a request."""
+        with self.lock:
+            self.requests += 1
+        time.sleep(self.latency)
+        if self._is_over_rate(host):
+            with self.lock:
+                self.throttled += 1
+            return 429, 'text/plain', 'Too Many Requests', {}
+
+        if method == 'GET' and path.endswith('.htm') and 'AjaxRecommend' not in path:
+            with self.lock:
+                self.page_loads += 1
+                token = self.token
+        if path == '/index.htm' and host == 'i.alibaba.com':
+            cookie = 'xman_us_t="ctoken=%s&l_source=alibaba"; Path=/; Domain=.alibaba.com' % token
+            return 200, 'text/html', '<html></html>', {'Set-Cookie': cookie}
+        if path == '/self/keyword.htm':
+            return 200, 'text/html', "<script>var dmtrack_pageid='simpageid';</script>", {}
+        if path == '/product/products_manage.htm':
+            return 200, 'text/html', "<script>var a = {_csrf_token_ : '%s'};</script>" % token, {}
+        if path == '/product/posting.htm':
+            return 200, 'text/html', "<script>var a = {'_csrf_token_':'%s'};</script>" % token, {}
+        if path == '/manage_ad_keyword.htm':
+            return 200, 'text/html', "<script>var a = {'_csrf_token_': '%s'};</script>" % token, {}
+        if method == 'GET' and path.endswith('.htm') and 'AjaxRecommend' not in path:
+            return 200, 'text/html', '<html></html>', {}
+        if not self._check_token(query, form):
+            return 403, 'text/plain', 'Forbidden', {}
+
+        if self.error_ratio and self.random.random() < self.error_ratio:
+            with self.lock:
+                self.errors += 1
+            return 503, 'text/plain', 'Service Unavailable', {}
+        if self.throttle_ratio and self.random.random() < self.throttle_ratio:
+            with self.lock:
+                self.throttled += 1
+            return 200, 'application/json', json.dumps({'successed': False}), {}
+        if path.endswith('asyQueryProductsList.do'):
+            body = self.products_page(int(form['page']), int(form['size']), form['gmtModified'])
+        elif query.get('iName') == 'searchKeywords':
+            body = self.keywords_page(form['keywords'], int(form['pageNO']), int(form['pageSize']))
+        elif query.get('iName') == 'getKeywordSearchProducts':
+            body = self.rank(form['keyword'])
+        elif path.endswith('AjaxRecommendPostCategory.htm'):
+            body = self.category(query['keyword'])
+        elif path.endswith('asyGetAdKeyword.do'):
+            body = self.p4p_page(json.loads(form['json'])['currentPage'])
+        else:
+            return 404, 'text/plain', 'Not Found', {}
+        return 200, 'application/json', json.dumps(body), {}
+
+    def products_page(self, page, size, order):
+        ids = list(range(1, self.products + 1))
+        if order == 'desc':
+            ids.reverse()
+        now = int(time.time() * 1000)
+        return {
+            'currentPage': page,
+            'count': self.products,
+            'products': [{
+                'id': x,
+                'redModel': 'SM%05d' % x,
+                'subject': 'product %d' % x,
+                'keywords': 'keyword %d, keyword %d, common keyword' % (x, x + 1),
+                'ownerMemberName': 'owner %d' % (x % 5),
+                'modifyTime': str(now - x * 86400000),
+                'mappedToYdtProduct': x % 2 == 0,
+                'isWindowProduct': x % 10 == 0,
+            } for x in ids[(page - 1) * size:page * size]],
+        }
+
+    def keywords_page(self, keyword, page, size):
+        start = (page - 1) * size
+        items = list()
+        for i in range(start, min(start + size, self.keyword_results)):
+            item = {
+                'keywords': '%s %d' % (keyword, i) if i > 0 else keyword,
+                'company_cnt': i * 10,
+                'showwin_cnt': i,
+                'yyyymm': time.strftime('%Y%m'),
+                'isP4pKeyword': i % 3 == 0,
+            }
+            item.update({x: (i + 1) * (12 - j) for j, x in enumerate(SRH_PV_KEYS)})
+            items.append(item)
+        return {'successed': True, 'value': {'total': self.keyword_results, 'data': items}}
+
+    def rank(self, keyword):
+        seed = sum(keyword.encode('utf-8'))
+        return {'value': [{
+            'id': (seed + i) % max(self.products, 1) + 1,
+            'pageNO': 1 + i // 30,
+            'rowNO': 1 + i % 30,
+        } for i in range(self.rank_results)]}
+
+    def category(self, keyword):
+        return {'categories': [{'enName': 'Category %d' % (len(keyword) % 7)}]}
+
+    def p4p_page(self, page):
+        return {
+            'totalPage': self.p4p_pages,
+            'currentPage': page,
+            'data': [{
+                'keyword': 'p4p keyword %d &amp; %d' % (page, i),
+                'qsStar': i % 5,
+                'state': str(i % 2),
+                'tag': ['tag %d' % (i % 3)],
+            } for i in range(20)],
+        }
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def _create_handler(simulator):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def _handle(self, method):
+            # 作为代理时请求行中是完整 URL
+            url = urlsplit(self.path)
+            host = url.hostname or self.headers.get('Host', '').split(':')[0]
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            form = dict()
+            length = int(self.headers.get('Content-Length') or 0)
+            if length > 0:
+                body = self.rfile.read(length).decode('utf-8')
+                form = {k: v[0] for k, v in parse_qs(body).items()}
+            status, content_type, body, headers = simulator.handle(
+                method, host, url.path, query, form)
+            data = body.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type + '; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self._handle('GET')
+
+        def do_POST(self):
+            self._handle('POST')
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+def start_server(simulator, port=0):
+    """start the simulator in a daemon thread, return the server, server_port is the port."""
+    server = _ThreadingHTTPServer(('127.0.0.1', port), _create_handler(simulator))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--products', type=int, default=500)
+    parser.add_argument('--keyword-results', type=int, default=25)
+    parser.add_argument('--rank-results', type=int, default=5)
+    parser.add_argument('--p4p-pages', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--max-rps', type=float, default=0)
+    parser.add_argument('--throttle-ratio', type=float, default=0)
+    parser.add_argument('--token-requests', type=int, default=0)
+    parser.add_argument('--error-ratio', type=float, default=0)
+    args = parser.parse_args()
+    simulator = Simulator(
+        products=args.products, keyword_results=args.keyword_results,
+        rank_results=args.rank_results, p4p_pages=args.p4p_pages, latency=args.latency,
+        max_rps=args.max_rps, throttle_ratio=args.throttle_ratio,
+        token_requests=args.token_requests, error_ratio=args.error_ratio,
+    )
+    server = start_server(simulator, args.port)
+    print('simulator listening on http://127.0.0.1:%d' % server.server_port)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#! /usr/bin/env python
+
+"""Benchmark loading the rank and products tables before and after `spider.py migrate`.
+
+A temporary database is filled with list columns in the former python literal encoding, the
+tables are loaded through the ORM, the database is migrated to the json encoding and the
+tables are loaded again. The decode time of the raw column values is reported as well.
+
+Usage:
+    python benchmarks/bench_array.py [rows]
+"""
+
+import os
+import sys
+import ast
+import json
+import time
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../ali_spider'))
+os.chdir(tempfile.mkdtemp())
+
+from sqlalchemy import text
+from database import Database
+from models import Product, Rank
+
+def fill_legacy(database, count):
+    products = [{
+        'id': i,
+        'keywords': str(['keyword %d' % i, 'keyword %d' % (i + 1), 'other keyword']),
+    } for i in range(count)]
+    ranks = [{
+        'keyword': 'keyword %d' % i,
+        'ranking': str([{'product_id': i + x, 'ranking': 1 + x / 100} for x in range(10)]),
+    } for i in range(count)]
+    database.session.execute(
+        text('INSERT INTO products (id, keywords) VALUES (:id, :keywords)'), products)
+    database.session.execute(
+        text('INSERT INTO rank (keyword, ranking) VALUES (:keyword, :ranking)'), ranks)
+    database.session.commit()
+
+def measure_load(database, model):
+    database.session.expunge_all()
+    start = time.perf_counter()
+    database.session.query(model).all()
+    return time.perf_counter() - start
+
+def measure_decode(database, decode):
+    values = [q for q, in database.session.execute(text('SELECT ranking FROM rank')).fetchall()]
+    start = time.perf_counter()
+    for value in values:
+        decode(value)
+    return time.perf_counter() - start
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    database = Database()
+    fill_legacy(database, count)
+
+    before = (measure_load(database, Rank), measure_load(database, Product),
+              measure_decode(database, ast.literal_eval))
+    start = time.perf_counter()
+    database.migrate()
+    migrate_time = time.perf_counter() - start
+    after = (measure_load(database, Rank), measure_load(database, Product),
+             measure_decode(database, json.loads))
+    database.close()
+
+    print('%d rows, migrate %.2f s' % (count, migrate_time))
+    print('%-16s %10s %10s' % ('', 'before', 'after'))
+    for name, x, y in zip(['load rank', 'load products', 'decode ranking'], before, after):
+        print('%-16s %9.3fs %9.3fs' % (name, x, y))
+
+if __name__ == "__main__":
+    main()
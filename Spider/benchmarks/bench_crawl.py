@@ -0,0 +1,135 @@
+#! /usr/bin/env python
+
+"""End-to-end crawl throughput against the local simulator.
+
+Starts benchmarks/alisim.py in process, points the crawler at it with settings.HTTP_PROXY and
+runs each craw_* path on a temporary database, reporting requests/s, rows/s and wall time. The
+crawler output is discarded.
+
+Usage:
+    python benchmarks/bench_crawl.py [--concurrency 4] [--products 200] [--latency 0.05]
+                                     [--metrics metrics.json] ...
+"""
+
+import io
+import os
+import sys
+import time
+import argparse
+import tempfile
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../ali_spider'))
+start_dir = os.getcwd()
+os.chdir(tempfile.mkdtemp())
+
+import requests
+import settings
+from database import Database
+from crawler import Crawler
+from models import Product, Keyword, Rank, P4P
+from metrics import REGISTRY
+from alisim import Simulator, start_server
+
+class SimulatorCrawler(Crawler):
+    """Crawler logged in by the simulator cookie instead of selenium."""
+
+    def _get_cookies_via_selenium(self):
+        return requests.cookies.RequestsCookieJar()
+
+def count_rows(database, model, **filters):
+    return database.session.query(model).filter_by(**filters).count()
+
+def measure(name, simulator, func):
+    simulator.reset_counters()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        rows = func()
+    elapsed = time.perf_counter() - start
+    print('%-10s %6d req %7.2f s %8.1f req/s %7d rows %9.1f rows/s %5d throttled %4d pages '
+          '%4d rejected %4d errors' % (
+        name, simulator.requests, elapsed, simulator.requests / elapsed, rows, rows / elapsed,
+        simulator.throttled, simulator.page_loads, simulator.rejected, simulator.errors))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--products', type=int, default=200)
+    parser.add_argument('--keyword-results', type=int, default=25)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--max-rps', type=float, default=0)
+    parser.add_argument('--throttle-ratio', type=float, default=0)
+    parser.add_argument('--token-requests', type=int, default=0,
+                        help='the simulator changes its tokens after this many requests')
+    parser.add_argument('--error-ratio', type=float, default=0,
+                        help='ratio of simulator API responses that are 503')
+    parser.add_argument('--rate', type=float, default=1000,
+                        help='client rate limit of each host, requests per second')
+    parser.add_argument('--metrics', help='write the crawl metrics JSON summary to this path')
+    args = parser.parse_args()
+
+    simulator = Simulator(
+        products=args.products, keyword_results=args.keyword_results, latency=args.latency,
+        max_rps=args.max_rps, throttle_ratio=args.throttle_ratio,
+        token_requests=args.token_requests, error_ratio=args.error_ratio,
+    )
+    server = start_server(simulator)
+    settings.HTTP_PROXY = 'http://127.0.0.1:%d' % server.server_port
+    for key in ['RATE_HZ_MYDATA', 'RATE_HZ_PRODUCTPOSTING', 'RATE_WWW2', 'RATE_DEFAULT',
+                'RATE_MAX']:
+        setattr(settings, key, args.rate)
+    settings.RATE_BURST = args.concurrency
+    # the simulator recovers at once, short backoffs keep the failure runs comparable
+    settings.HTTP_BACKOFF_BASE = 0.01
+    settings.HTTP_BACKOFF_MAX = 0.1
+    settings.CIRCUIT_OPEN_SECONDS = 0.1
+    os.makedirs('./config', exist_ok=True)
+    open(settings.NEGATIVE_KEYWORDS_FILE, 'w').close()
+    open(settings.BASE_KEYWORDS_FILE, 'w').close()
+
+    database = Database()
+    crawlers = list()
+
+    def start_crawler():
+        # a new crawler starts with the session state saved by the previous one
+        crawlers.append(SimulatorCrawler(database=database, concurrency=args.concurrency))
+        return 0
+
+    def craw_products():
+        crawlers[-1].craw_products(forceupdate=True)
+        return count_rows(database, Product)
+
+    def craw_keywords():
+        crawlers[-1].craw_keywords(category=False)
+        return count_rows(database, Keyword)
+
+    def craw_category():
+        crawlers[-1].craw_keywords_category()
+        return database.session.query(Keyword).filter(Keyword.category.isnot(None)).count()
+
+    def craw_rank():
+        crawlers[-1].craw_rank()
+        return count_rows(database, Rank)
+
+    def craw_p4p():
+        crawlers[-1].craw_p4p()
+        return count_rows(database, P4P)
+
+    print('concurrency %d, latency %.3f s' % (args.concurrency, args.latency))
+    measure('login', simulator, start_crawler)
+    measure('products', simulator, craw_products)
+    measure('keywords', simulator, craw_keywords)
+    measure('category', simulator, craw_category)
+    measure('rank', simulator, craw_rank)
+    measure('p4p', simulator, craw_p4p)
+    crawlers[-1].save_session_state()
+    measure('restart', simulator, start_crawler)
+    measure('products', simulator, craw_products)
+    print('dead letters %d' % len(database.get_dead_letters()))
+    database.close()
+    server.shutdown()
+    if args.metrics:
+        REGISTRY.write_json(os.path.abspath(os.path.join(start_dir, args.metrics)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#! /usr/bin/env python
+
+"""Import time of the spider.py commands.
+
+Each command runs in a new interpreter with `python -X importtime` in a temporary directory with
+an empty database. The report shows the wall time of the process, the total import time, the
+slowest top level imports and whether requests, selenium, numpy or sqlalchemy were loaded.
+craw needs a login, so only the modules it imports are measured.
+
+Usage:
+    python benchmarks/bench_import.py [repeat]
+"""
+
+import os
+import re
+import sys
+import time
+import tempfile
+import subprocess
+
+SPIDER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../ali_spider')
+SPIDER = os.path.join(SPIDER_DIR, 'spider.py')
+HEAVY_MODULES = ['requests', 'selenium', 'numpy', 'sqlalchemy']
+COMMANDS = [
+    ('--help', [SPIDER, '--help']),
+    ('generate overview', [SPIDER, 'generate', 'overview']),
+    ('generate trends', [SPIDER, 'generate', 'trends']),
+    ('history', [SPIDER, 'history', 'keyword', 'led']),
+    ('migrate', [SPIDER, 'migrate']),
+    ('craw (imports)', ['-c', 'import sys; sys.path.insert(0, %r); import spider, database, '
+                              'crawler, metrics' % SPIDER_DIR]),
+]
+_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+def run(argv):
+    """return (wall seconds, [(cumulative us, depth, module)]) of one process"""
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, '-X', 'importtime'] + argv,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                             universal_newlines=True)
+    elapsed = time.perf_counter() - start
+    imports = list()
+    for line in process.stderr.splitlines():
+        match = _LINE.match(line)
+        if match:
+            imports.append((int(match.group(2)), len(match.group(3)) // 2, match.group(4)))
+    return elapsed, imports
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    os.chdir(tempfile.mkdtemp())
+    os.makedirs('./config', exist_ok=True)
+    open('./config/negative_keywords.txt', 'w').close()
+    open('./config/base_keywords.txt', 'w').close()
+    run([SPIDER, 'migrate'])
+
+    for name, argv in COMMANDS:
+        runs = [run(argv) for _ in range(repeat)]
+        elapsed, imports = min(runs, key=lambda x: x[0])
+        top = sorted([x for x in imports if x[1] == 0], reverse=True)
+        loaded = set(x[2].split('.')[0] for x in imports)
+        print('%-18s wall %7.1f ms  imports %7.1f ms  %4d modules  heavy: %s' % (
+            name, elapsed * 1000, sum(x[0] for x in top) / 1000, len(imports),
+            ', '.join(x for x in HEAVY_MODULES if x in loaded) or '-'))
+        print('    slowest: %s' % ', '.join('%s %.1f ms' % (x[2], x[0] / 1000) for x in top[:4]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#! /usr/bin/env python
+
+"""Benchmark the SQLite storage profile.
+
+For the SQLite default profile and the profile of settings, keywords are upserted with a commit
+per batch, as the crawler does, while another connection keeps reading the keywords table like
+the report generator. Then the product staleness check runs on a large products table.
+
+Usage:
+    python benchmarks/bench_storage.py [rows]
+"""
+
+import os
+import sys
+import time
+import tempfile
+import threading
+from datetime import datetime, date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../ali_spider'))
+os.chdir(tempfile.mkdtemp())
+
+from sqlalchemy.exc import OperationalError
+import settings
+from database import Database
+from models import Keyword, Product
+
+PROFILES = {
+    'default': {'DATABASE_JOURNAL_MODE': '', 'DATABASE_SYNCHRONOUS': '',
+                'DATABASE_CACHE_SIZE': 0, 'DATABASE_MMAP_SIZE': 0},
+    'settings': {x: getattr(settings, x) for x in ['DATABASE_JOURNAL_MODE',
+                                                    'DATABASE_SYNCHRONOUS',
+                                                    'DATABASE_CACHE_SIZE',
+                                                    'DATABASE_MMAP_SIZE']},
+}
+
+def read_keywords(stop, result):
+    database = Database()
+    while not stop.is_set():
+        try:
+            database.get_keywords_info()
+            result['reads'] += 1
+        except OperationalError:
+            database.session.rollback()
+            result['read_errors'] += 1
+    database.close()
+
+def measure(name, count):
+    for key, value in PROFILES[name].items():
+        setattr(settings, key, value)
+    settings.DATABASE_URL = 'sqlite:///./database/%s.db' % name
+    settings.DATABASE_COMMIT_INTERVAL = settings.DATABASE_BATCH_SIZE
+    database = Database()
+    database.session.execute(Product.__table__.insert(), [{
+        'id': i, 'update': date.today() - timedelta(days=i % 2)} for i in range(count)])
+    database.session.commit()
+
+    stop = threading.Event()
+    result = {'reads': 0, 'read_errors': 0, 'write_errors': 0}
+    reader = threading.Thread(target=read_keywords, args=(stop, result))
+    reader.start()
+    start = time.perf_counter()
+    for i in range(0, count, 500):
+        try:
+            database.bulk_upsert_keywords([Keyword(
+                value='keyword %d' % x, company_cnt=x, update=datetime.now(),
+            ) for x in range(i, i + 500)])
+        except OperationalError:
+            database.session.rollback()
+            result['write_errors'] += 1
+    write_time = time.perf_counter() - start
+    stop.set()
+    reader.join()
+
+    start = time.perf_counter()
+    for _ in range(20):
+        database.is_products_need_update()
+    check_time = (time.perf_counter() - start) / 20
+    database.close()
+    print('%-9s write %7.2f s %8.0f rows/s  reads %5d  errors r/w %d/%d  stale check %6.2f ms' % (
+        name, write_time, count / write_time, result['reads'], result['read_errors'],
+        result['write_errors'], check_time * 1000))
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    os.makedirs('./config', exist_ok=True)
+    open(settings.NEGATIVE_KEYWORDS_FILE, 'w').close()
+    measure('default', count)
+    measure('settings', count)
+
+if __name__ == "__main__":
+    main()
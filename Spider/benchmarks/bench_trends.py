@@ -0,0 +1,54 @@
+#! /usr/bin/env python
+
+"""Benchmark the srh_pv trend analytics.
+
+Fills a temporary database with keywords, then times loading the srh_pv matrix, the
+vectorized trend computation and producing the report rows.
+
+Usage:
+    python benchmarks/bench_trends.py [rows]
+"""
+
+import os
+import sys
+import time
+import random
+import tempfile
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../ali_spider'))
+os.chdir(tempfile.mkdtemp())
+
+import settings
+from database import Database
+from models import Keyword, SRH_PV_KEYS
+from analytics import TrendReport
+
+def fill_keywords(database, count):
+    random.seed(0)
+    database.bulk_upsert_keywords([Keyword(
+        value='keyword %d' % i,
+        update=datetime(2026, 10, 3, 9),
+        srh_pv={x: random.randint(0, 5000) for x in SRH_PV_KEYS},
+    ) for i in range(count)])
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    os.makedirs('./config', exist_ok=True)
+    open(settings.NEGATIVE_KEYWORDS_FILE, 'w').close()
+    database = Database()
+    fill_keywords(database, count)
+
+    start = time.perf_counter()
+    report = TrendReport(database)
+    loaded = time.perf_counter()
+    rows = sum(1 for _ in report.rows())
+    end = time.perf_counter()
+    database.close()
+
+    print('%d keywords' % rows)
+    print('load and compute %8.2f s' % (loaded - start))
+    print('report rows      %8.2f s' % (end - loaded))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#! /usr/bin/env python
+
+"""Benchmark keyword and rank upserts.
+
+Compares the old select-then-write ORM path (one SELECT per row, one commit per rank) with
+Database.bulk_upsert_keywords / bulk_upsert_ranks. Each path inserts all rows and then updates
+them again, on a temporary database.
+
+Usage:
+    python benchmarks/bench_upsert.py [rows]
+"""
+
+import os
+import sys
+import time
+import tempfile
+from datetime import datetime, date
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../ali_spider'))
+os.chdir(tempfile.mkdtemp())
+
+import settings
+from database import Database
+from models import Keyword, Rank
+
+def make_keywords(count):
+    return [Keyword(
+        value='keyword %d' % i,
+        company_cnt=i,
+        showwin_cnt=i,
+        update=datetime.now(),
+        srh_pv={'srh_pv_this_mon': i},
+    ) for i in range(count)]
+
+def make_ranks(count):
+    return [Rank(
+        keyword='keyword %d' % i,
+        ranking=[{'product_id': i, 'ranking': 1.01}],
+        update=date.today(),
+    ) for i in range(count)]
+
+def legacy_upsert_keywords(database, keywords):
+    session = database.session
+    for i in range(0, len(keywords), 10):
+        for keyword in keywords[i:i+10]:
+            record = session.query(Keyword).filter_by(value=keyword.value).first()
+            if record is not None:
+                record.company_cnt = keyword.company_cnt
+                record.showwin_cnt = keyword.showwin_cnt
+                record.srh_pv = keyword.srh_pv
+                record.update = keyword.update
+            else:
+                session.add(keyword)
+        session.commit()
+
+def legacy_upsert_ranks(database, ranks):
+    session = database.session
+    for rank in ranks:
+        record = session.query(Rank).filter_by(keyword=rank.keyword).first()
+        if record is not None:
+            record.ranking = rank.ranking
+            record.update = rank.update
+        else:
+            session.add(rank)
+        session.commit()
+
+def measure(name, count, func, make_rows):
+    settings.DATABASE_URL = 'sqlite:///./database/%s.db' % name
+    database = Database()
+    elapsed = 0
+    for _ in range(2):
+        rows = make_rows(count)
+        start = time.perf_counter()
+        func(database, rows)
+        elapsed += time.perf_counter() - start
+    database.close()
+    print('%-16s %8d rows %8.2f s %10.0f rows/s' % (name, count * 2, elapsed, count * 2 / elapsed))
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    measure('legacy_keywords', count, legacy_upsert_keywords, make_keywords)
+    measure('bulk_keywords', count, Database.bulk_upsert_keywords, make_keywords)
+    measure('legacy_ranks', count, legacy_upsert_ranks, make_ranks)
+    measure('bulk_ranks', count, Database.bulk_upsert_ranks, make_ranks)
+
+if __name__ == "__main__":
+    main()